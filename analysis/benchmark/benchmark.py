@@ -0,0 +1,265 @@
+# ------------------------------------------------------------------------------
+#
+# benchmark.py
+#
+# This file benchmarks the dates and prevax dataset definitions against ehrQL's
+# local file engine on synthetic populations of increasing size, so that
+# performance regressions are caught before they reach the backend. Dummy
+# tables come from analysis/dummy_data/generate_dummy_tables.py
+#
+# Usage (from the repository root, in an environment with ehrQL v1 installed;
+# see require_ehrql in utility.py):
+#   python analysis/benchmark/benchmark.py run [--sizes 10000,100000,1000000,5000000]
+#   python analysis/benchmark/benchmark.py compare BASE_COMMIT [HEAD_COMMIT]
+#
+# Arguments (run):
+#  - --sizes - comma separated synthetic population sizes
+#  - --actions - comma separated actions to benchmark (dates, prevax); they
+#                run in that order, and prevax reads the index dates written
+#                by dates at the same size, so it needs dates in the same run
+#                or an earlier one with the same --workdir
+#  - --workdir - scratch directory for dummy tables and outputs
+#  - --results - results file (JSON lines, one record per measurement)
+#
+# Returns:
+#  - One record per action and population size, and per action, variable
+#    group and population size, with wall time (s), peak RSS (MB) and output
+#    size (bytes), tagged with the current commit
+#    (output/benchmark/benchmark_results.jsonl)
+#  - compare prints the ratio of each measurement between two commits
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utility import load_dataset, dataset_variables, dataset_population, query_nodes, subset_dataset, variable_group
+
+generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dummy_data", "generate_dummy_tables.py")
+sys.path.insert(0, os.path.dirname(generator))
+
+from generate_dummy_tables import generated_tables
+
+actions = dict(
+    dates=dict(
+        definition="analysis/dataset_definition/dataset_definition_dates.py",
+        output="index_dates.arrow",
+    ),
+    prevax=dict(
+        definition="analysis/dataset_definition/dataset_definition_prevax.py",
+        output="input_prevax.arrow",
+    ),
+)
+
+default_sizes = [10000, 100000, 1000000, 5000000]
+default_results = "output/benchmark/benchmark_results.jsonl"
+
+
+# Measure a child process ------------------------------------------------------
+# os.wait4 gives the resource usage of that child alone; ru_maxrss is in KB on Linux
+
+def measure(command, env):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return dict(wall_seconds=round(wall, 3), peak_rss_mb=round(usage.ru_maxrss / 1024, 1))
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path) for name in names
+        )
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+# Benchmark one action at one population size ----------------------------------
+
+def benchmark_action(action, size, workdir, env):
+    definition = actions[action]["definition"]
+    tables = os.path.join(workdir, f"{action}-{size}-tables")
+    output = os.path.join(workdir, f"{size}-{actions[action]['output']}")
+    ehrql = [sys.executable, "-m", "ehrql"]
+
+    # tables from generate_dummy_tables.py, with the tables it does not model written empty
+    definition_info = describe_definition(definition, env)
+    shutil.rmtree(tables, ignore_errors=True)
+    command = [sys.executable, generator, tables, "--population-size", str(size)]
+    for table in sorted(set(definition_info["tables"]) - set(generated_tables)):
+        command += ["--empty-table", table]
+    dummy = measure(command, env)
+    records = [dict(action=action, size=size, step="dummy_tables", output_bytes=path_size(tables), **dummy)]
+
+    extract = measure(
+        ehrql + ["generate-dataset", definition, "--dummy-tables", tables, "--output", output], env
+    )
+    records.append(dict(action=action, size=size, step="generate_dataset", output_bytes=path_size(output), **extract))
+
+    groups = sorted({variable_group(name) for name in definition_info["variables"]})
+    for group in groups:
+        result = os.path.join(workdir, f"{action}-{size}-{group}.rows")
+        evaluate = measure(
+            [sys.executable, os.path.abspath(__file__), "evaluate-group", definition, tables, group, result], env
+        )
+        records.append(dict(action=action, size=size, step="group", group=group, output_bytes=path_size(result), **evaluate))
+        os.remove(result)
+
+    shutil.rmtree(tables, ignore_errors=True)
+    return records
+
+# The definition's variables and tables, read in a child process so that env
+# (e.g. INDEX_DATES_PATH) only applies to that process
+
+def describe_definition(definition, env):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "describe", definition],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+def definition_tables(dataset):
+    roots = [dataset_population(dataset)._qm_node]
+    roots += [series._qm_node for series in dataset_variables(dataset).values()]
+    return sorted({
+        node.name for root in roots for node in query_nodes(root)
+        if type(node).__qualname__ in ("SelectTable", "SelectPatientTable")
+    })
+
+
+# Evaluate one variable group (run in its own process so RSS is per group) ------
+
+def evaluate_group(definition, tables, group, result):
+    from ehrql.query_engines.local_file import LocalFileQueryEngine
+
+    dataset = load_dataset(definition)
+    subset = subset_dataset(
+        dataset, [name for name in dataset_variables(dataset) if variable_group(name) == group]
+    )
+
+    engine = LocalFileQueryEngine(tables)
+    with open(result, "w") as f:
+        for table in engine.get_results_tables(subset._compile()):
+            for row in table:
+                f.write(repr(tuple(row)) + "\n")
+
+
+# Run and compare --------------------------------------------------------------
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def index_dates_output(workdir, size):
+    return os.path.join(workdir, f"{size}-{actions['dates']['output']}")
+
+def run(sizes, selected_actions, workdir, results):
+    unknown = set(selected_actions) - set(actions)
+    if unknown:
+        raise ValueError(f"unknown actions: {', '.join(sorted(unknown))} (choose from {', '.join(actions)})")
+    os.makedirs(workdir, exist_ok=True)
+    os.makedirs(os.path.dirname(results) or ".", exist_ok=True)
+    run_info = dict(
+        commit=current_commit(),
+        timestamp=datetime.datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        cpus=os.cpu_count(),
+    )
+    for size in sizes:
+        # the prevax definition reads the index dates written by dates at this size, never the
+        # project's output/dataset_definition/index_dates.arrow
+        env = dict(os.environ, DUMMY_POPULATION_SIZE=str(size), INDEX_DATES_PATH=index_dates_output(workdir, size))
+        for action in [action for action in actions if action in selected_actions]:
+            if action == "prevax" and not os.path.exists(env["INDEX_DATES_PATH"]):
+                raise FileNotFoundError(
+                    f"prevax needs the index dates from dates at size {size} ({env['INDEX_DATES_PATH']}); "
+                    "run with --actions dates,prevax"
+                )
+            records = benchmark_action(action, size, workdir, env)
+            with open(results, "a") as f:
+                for record in records:
+                    f.write(json.dumps(dict(run_info, **record)) + "\n")
+                    print(json.dumps(record))
+
+def load_results(results, commit):
+    latest = {}
+    with open(results) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["commit"] == commit:
+                key = (record["action"], record["size"], record["step"], record.get("group", ""))
+                latest[key] = record
+    return latest
+
+def compare(results, base, head):
+    base_records, head_records = load_results(results, base), load_results(results, head)
+    print(f"{'action':<8} {'size':>9} {'step':<17} {'group':<12} {'wall':>8} {'rss':>8} {'bytes':>8}")
+    for key in sorted(set(base_records) & set(head_records)):
+        old, new = base_records[key], head_records[key]
+        ratios = [
+            new[metric] / old[metric] if old[metric] else float("nan")
+            for metric in ("wall_seconds", "peak_rss_mb", "output_bytes")
+        ]
+        print(f"{key[0]:<8} {key[1]:>9} {key[2]:<17} {key[3]:<12} " + " ".join(f"{ratio:>8.2f}" for ratio in ratios))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dataset definitions on synthetic populations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--sizes", default=",".join(str(size) for size in default_sizes))
+    run_parser.add_argument("--actions", default=",".join(actions))
+    run_parser.add_argument("--workdir", default="output/benchmark/work")
+    run_parser.add_argument("--results", default=default_results)
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head", nargs="?", default=None)
+    compare_parser.add_argument("--results", default=default_results)
+
+    describe_parser = subparsers.add_parser("describe")
+    describe_parser.add_argument("definition")
+
+    group_parser = subparsers.add_parser("evaluate-group")
+    for argument in ("definition", "tables", "group", "result"):
+        group_parser.add_argument(argument)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(
+            [int(size) for size in args.sizes.split(",")],
+            args.actions.split(","),
+            args.workdir,
+            args.results,
+        )
+    elif args.command == "compare":
+        compare(args.results, args.base, args.head or current_commit())
+    elif args.command == "describe":
+        dataset = load_dataset(args.definition)
+        print(json.dumps(dict(variables=list(dataset_variables(dataset)), tables=definition_tables(dataset))))
+    else:
+        evaluate_group(args.definition, args.tables, args.group, args.result)
+
+
+if __name__ == "__main__":
+    main()
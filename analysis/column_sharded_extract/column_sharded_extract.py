@@ -0,0 +1,176 @@
+# ------------------------------------------------------------------------------
+#
+# column_sharded_extract.py
+#
+# This file extracts a dataset definition as independent column groups, one
+# per large backend table (see dataset_definition/column_groups.py), run in
+# parallel, and merge-joins them on patient_id into the wide dataset, so
+# that the apcs, clinical_events and medications scans no longer run one
+# after another in a single query
+#
+# Usage (from the repository root, in an environment with ehrQL v1 installed;
+# see require_ehrql in utility.py):
+#   python analysis/column_sharded_extract/column_sharded_extract.py groups \
+#     analysis/dataset_definition/dataset_definition_prevax.py
+#   python analysis/column_sharded_extract/column_sharded_extract.py run \
+#     analysis/dataset_definition/dataset_definition_prevax.py \
+#     --output output/dataset_definition/input_prevax.arrow \
+#     [--jobs N] [--dummy-tables DIR] [-- USER_ARGS]
+#   python analysis/column_sharded_extract/column_sharded_extract.py merge \
+#     output/dataset_definition/input_prevax.arrow GROUP_OUTPUTS... \
+#     [--order DEFINITION]
+#
+# Arguments:
+#  - groups - prints the column group of each variable
+#  - run - runs one generate-dataset per column group (with
+#          `--column-group NAME` appended to USER_ARGS) in at most --jobs
+#          processes and merges them into --output, in the definition's
+#          column order
+#  - merge - merge-joins group outputs (.arrow, .csv or .csv.gz) on
+#            patient_id; columns are ordered as in the --order definition,
+#            or as in the group outputs without it
+#  - --dummy-tables - directory of tables to extract from; every group must
+#                     read the same tables (and so the same population),
+#                     so locally this should be given
+#
+# Returns:
+#  - groups: one line per group with its variables
+#  - run and merge: the dataset at --output
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+analysis_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, analysis_dir)
+sys.path.insert(0, os.path.join(analysis_dir, "dataset_definition"))
+
+from utility import dataset_variables, load_dataset, output_suffix, read_output, write_output
+
+
+# Column groups ----------------------------------------------------------------
+
+def definition_groups(definition, user_args=()):
+    from column_groups import column_groups
+
+    dataset = load_dataset(definition, user_args)
+    variables = dataset_variables(dataset)
+    return column_groups(variables), list(variables)
+
+
+# Merge-join -------------------------------------------------------------------
+# ehrQL writes every output ordered by patient_id, and the column groups share
+# the population, so their patient_id columns are identical and the join is a
+# single pass comparing them; outputs with different patients (e.g. run
+# against different tables) are an error rather than silently misaligned
+
+def is_sorted(patient_ids):
+    if len(patient_ids) < 2:
+        return True
+    return pc.all(pc.less(patient_ids.slice(0, len(patient_ids) - 1), patient_ids.slice(1))).as_py()
+
+def merge_join(tables):
+    patient_ids = tables[0].column("patient_id")
+    if not is_sorted(patient_ids):
+        raise ValueError("group outputs must be ordered by patient_id")
+    columns = {"patient_id": patient_ids}
+    for table in tables:
+        if not table.column("patient_id").equals(patient_ids):
+            raise ValueError("group outputs do not have the same patients")
+        for name in table.column_names:
+            if name != "patient_id":
+                columns[name] = table.column(name)
+    return pa.table(columns)
+
+def merge(output, group_outputs, order=None):
+    merged = merge_join([read_output(path) for path in group_outputs])
+    if order is not None:
+        merged = merged.select(["patient_id"] + [name for name in order if name in merged.column_names])
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    write_output(merged, output)
+
+
+# Run locally ------------------------------------------------------------------
+
+def generate(definition, output, dummy_tables, user_args):
+    command = [sys.executable, "-m", "ehrql", "generate-dataset", definition, "--output", output]
+    if dummy_tables is not None:
+        command += ["--dummy-tables", dummy_tables]
+    if user_args:
+        command += ["--", *user_args]
+    subprocess.run(command, check=True)
+
+def run(definition, output, jobs=None, dummy_tables=None, user_args=()):
+    start = time.perf_counter()
+    groups, order = definition_groups(definition, user_args)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="column_sharded_extract_", dir=os.path.dirname(output) or ".")
+    try:
+        group_outputs = {group: os.path.join(workdir, group + output_suffix(output)) for group in groups}
+        with ThreadPoolExecutor(max_workers=jobs or len(groups)) as pool:
+            futures = [
+                pool.submit(generate, definition, group_output, dummy_tables, [*user_args, "--column-group", group])
+                for group, group_output in group_outputs.items()
+            ]
+            for future in futures:
+                future.result()
+        merge(output, list(group_outputs.values()), order)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(
+        f"column sharded extract: {output} from {len(groups)} column groups "
+        f"({', '.join(groups)}) in {time.perf_counter() - start:.1f}s",
+        file=sys.stderr
+    )
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    user_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, user_args = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description="Extract a dataset definition in column groups and merge-join them")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    groups_parser = commands.add_parser("groups", help="print the column group of each variable")
+    groups_parser.add_argument("definition")
+
+    run_parser = commands.add_parser("run", help="extract all column groups locally and merge-join them")
+    run_parser.add_argument("definition")
+    run_parser.add_argument("--output", required=True)
+    run_parser.add_argument("--jobs", type=int, default=None)
+    run_parser.add_argument("--dummy-tables", default=None)
+
+    merge_parser = commands.add_parser("merge", help="merge-join column group outputs on patient_id")
+    merge_parser.add_argument("output")
+    merge_parser.add_argument("group_outputs", nargs="+")
+    merge_parser.add_argument("--order", default=None, help="definition whose column order the output follows")
+
+    args = parser.parse_args(argv)
+    if args.command == "groups":
+        groups, _ = definition_groups(args.definition, user_args)
+        for group, names in groups.items():
+            print(f"{group} ({len(names)}): {' '.join(names)}")
+    elif args.command == "run":
+        run(args.definition, args.output, args.jobs, args.dummy_tables, user_args)
+    else:
+        order = list(dataset_variables(load_dataset(args.order, user_args))) if args.order else None
+        merge(args.output, args.group_outputs, order)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# Compiled codelist cache
+#
+# codelist_from_csv is a lazy replacement for ehrql.codelist_from_csv used by codelists.py: it returns
+# a LazyCodelist that is only parsed (via load_codelist) the first time it is used, then memoized.
+# LazyCodelists can be combined with + just like the lists returned by ehrql.codelist_from_csv. Each call also
+# declares the codelist's coding system (snomed, ctv3, dmd or icd10), which ehrQL does not need but local tooling
+# (e.g. the dummy table generator) reads from LazyCodelist.sources.
+#
+# load_codelist can read codelists through a compiled cache for local runs. Parsed codelists (codes, plus
+# categories where category_column is given) are stored in a single binary file, keyed by the CSV path, column
+# and category column. Each entry records the SHA-256 of the CSV it was built from, so only entries whose source
+# file has changed are re-parsed. The file size and modification time are checked first so unchanged files are
+# not re-hashed.
+#
+# The cache is opt-in: it is only used when CODELIST_CACHE_PATH is set (e.g. to
+# output/.codelist_cache/codelists.pickle for local tooling), so backend actions parse the CSV files as usual and
+# write nothing outside their declared outputs. The file is read with pickle, so only point CODELIST_CACHE_PATH
+# at a location you control. If it cannot be read or written codelists are parsed from the CSV files.
+
+import atexit
+import hashlib
+import os
+import pickle
+
+CACHE_PATH = os.environ.get("CODELIST_CACHE_PATH") or None
+CACHE_VERSION = 1
+
+def load_cache(path=CACHE_PATH):
+    if path is None:
+        return {}
+    try:
+        with open(path, "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache["entries"]
+
+def save_cache(entries, path=CACHE_PATH):
+    if path is None:
+        return False
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": CACHE_VERSION, "entries": entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+def file_digest(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+_entries = load_cache()
+_changed = False
+
+# written once, when the process exits, and only if an entry was added or updated
+
+@atexit.register
+def save_changed_entries():
+    if _changed:
+        save_cache(_entries)
+
+def parse_codelist(filename, column, category_column=None):
+    # imported here so codelists.py can be imported (e.g. for its sources) without ehrql
+    from ehrql import codelist_from_csv as parse_codelist_from_csv
+
+    return parse_codelist_from_csv(filename, column=column, category_column=category_column)
+
+def load_codelist(filename, column, category_column=None):
+    global _changed
+    if CACHE_PATH is None:
+        return parse_codelist(filename, column, category_column)
+    key = (filename, column, category_column)
+    stat = os.stat(filename)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    entry = _entries.get(key)
+    if entry is not None and entry["signature"] == signature:
+        return entry["codelist"]
+    digest = file_digest(filename)
+    if entry is not None and entry["digest"] == digest:
+        entry["signature"] = signature
+    else:
+        entry = dict(
+            digest=digest,
+            signature=signature,
+            codelist=parse_codelist(filename, column, category_column),
+        )
+        _entries[key] = entry
+    _changed = True
+    return entry["codelist"]
+
+class LazyCodelist:
+    # sources: the (filename, column, category_column, system) of each CSV the codelist is built from
+    def __init__(self, loader, sources):
+        self._loader = loader
+        self._value = None
+        self.sources = sources
+
+    def load(self):
+        if self._value is None:
+            self._value = self._loader()
+        return self._value
+
+    def __add__(self, other):
+        return LazyCodelist(lambda: self.load() + other.load(), self.sources + other.sources)
+
+coding_systems = ("snomed", "ctv3", "dmd", "icd10")
+
+def codelist_from_csv(filename, column, category_column=None, *, system):
+    if system not in coding_systems:
+        raise ValueError(f"{filename}: system must be one of {', '.join(coding_systems)}, not {system!r}")
+    return LazyCodelist(
+        lambda: load_codelist(filename, column=column, category_column=category_column),
+        [(filename, column, category_column, system)],
+    )
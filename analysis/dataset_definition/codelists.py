@@ -18,26 +18,36 @@ PROJECT SPECIFIC (PLEASE EDIT FOR YOUR PROJECT):
 
 # Setup ------------------------------------------------------------------------
 
-from ehrql import codelist_from_csv
+# codelist_from_csv defers parsing until a codelist is first accessed (through the compiled codelist
+# cache, when CODELIST_CACHE_PATH is set; see codelist_cache.py); import codelists by name, e.g.
+# `from codelists import ami_snomed`, so that an action only parses the codelists it uses
+import os
+import sys
+import atexit
+from codelist_cache import codelist_from_csv, LazyCodelist
 
 # Exposures --------------------------------------------------------------------
 
 ## COVID-19
 covid_codes = codelist_from_csv(
     "codelists/user-RochelleKnight-confirmed-hospitalised-covid-19.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 covid_primary_care_positive_test = codelist_from_csv(
     "codelists/opensafely-covid-identification-in-primary-care-probable-covid-positive-test.csv",
-    column="CTV3ID"
+    column="CTV3ID",
+    system="ctv3"
 )
 covid_primary_care_code = codelist_from_csv(
     "codelists/opensafely-covid-identification-in-primary-care-probable-covid-clinical-code.csv",
-    column="CTV3ID"
+    column="CTV3ID",
+    system="ctv3"
 )
 covid_primary_care_sequalae = codelist_from_csv(
     "codelists/opensafely-covid-identification-in-primary-care-probable-covid-sequelae.csv",
-    column="CTV3ID"
+    column="CTV3ID",
+    system="ctv3"
 )
 
 # Quality assurance ------------------------------------------------------------
@@ -45,29 +55,34 @@ covid_primary_care_sequalae = codelist_from_csv(
 ## Prostate cancer
 prostate_cancer_snomed = codelist_from_csv(
     "codelists/user-RochelleKnight-prostate_cancer_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 prostate_cancer_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-prostate_cancer_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 
 ## Pregnancy
 pregnancy_snomed = codelist_from_csv(
     "codelists/user-RochelleKnight-pregnancy_and_birth_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Combined oral contraceptive pill
 cocp_dmd = codelist_from_csv(
     "codelists/user-elsie_horne-cocp_dmd.csv",
-    column="dmd_id"
+    column="dmd_id",
+    system="dmd"
 )
 
 ## Hormone replacement therapy
 hrt_dmd = codelist_from_csv(
     "codelists/user-elsie_horne-hrt_dmd.csv",
-    column="dmd_id"
+    column="dmd_id",
+    system="dmd"
 )
 
 # JCVI groups ------------------------------------------------------------------
@@ -75,157 +90,183 @@ hrt_dmd = codelist_from_csv(
 ## Wider learning disability
 learndis_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-learndis.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Patients in long-stay nursing and residential care
 longres_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-longres.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## High risk from COVID-19 code
 shield_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-shield.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Lower risk from COVID-19
 nonshield_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-nonshield.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Pregnancy
 preg_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-preg.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Pregnancy or delivery
 pregdel_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-pregdel.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## All BMI coded terms
 bmi_stage_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-bmi_stage.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Severe obesity code recorded
 sev_obesity_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-sev_obesity.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Asthma diagnosis code
 ast_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-ast.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Asthma admission
 astadm_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-astadm.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Asthma systemic steroid prescription
 astrx_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-astrx.csv",
-    column="code"
+    column="code",
+    system="dmd"
 )
 
 ## Chronic Respiratory Disease
 resp_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-resp_cov.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Chronic neurological disease including significantlearning disorder
 cns_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-cns_cov.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Asplenia or dysfunction of the spleen
 spln_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-spln_cov.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Diabetes diagnosis
 diab_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-diab.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Diabetes resolved
 dmres_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-dmres.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Severe mental illness
 sev_mental_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-sev_mental.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Remission relating to severe mental illness
 smhres_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-smhres.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Chronic heart disease
 chd_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-chd_cov.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Chronic kidney disease diagnostic
 ckd_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-ckd_cov.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Chronic kidney disease - all stages
 ckd15_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-ckd15.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Chronic kidney disease-stages 3 - 5
 ckd35_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-ckd35.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Chronic liver disease
 cld_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-cld.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Immunosuppression diagnosis
 immdx_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ## Immunosuppression medication
 immrx_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-immrx.csv",
-    column="code"
+    column="code",
+    system="dmd"
 )
 
 # Household contact of shielding individual
 hhld_imdef_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-hhld_imdef.csv",
     column="code",
+    system="snomed"
 )
 
 # Strata -----------------------------------------------------------------------
@@ -245,7 +286,8 @@ hhld_imdef_primis = codelist_from_csv(
 ethnicity_snomed = codelist_from_csv(
     "codelists/opensafely-ethnicity-snomed-0removed.csv",
     column="code",
-    category_column="Grouping_6"
+    category_column="Grouping_6",
+    system="snomed"
 )
 
 ### Deprivation 
@@ -255,7 +297,8 @@ ethnicity_snomed = codelist_from_csv(
 smoking_clear = codelist_from_csv(
     "codelists/opensafely-smoking-clear.csv",
     column="CTV3Code",
-    category_column="Category"
+    category_column="Category",
+    system="ctv3"
 )
 
 ### Care home status 
@@ -270,19 +313,23 @@ smoking_clear = codelist_from_csv(
 ### Dementia 
 dementia_nonvas_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-dementia_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 dementia_vas_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-dementia_vascular_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 dementia_nonvas_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-dementia_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 dementia_vas_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-dementia_vascular_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 dementia_snomed = dementia_nonvas_snomed + dementia_vas_snomed
 dementia_icd10 = dementia_nonvas_icd10 + dementia_vas_icd10
@@ -290,117 +337,141 @@ dementia_icd10 = dementia_nonvas_icd10 + dementia_vas_icd10
 ### Liver disease 
 liver_disease_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-liver_disease_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 liver_disease_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-liver_disease_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 
 ### Chronic kidney disease 
 ckd_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-ckd_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 ckd_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-ckd_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 
 ### Cancer 
 cancer_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-cancer_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 cancer_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-cancer_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 
 ### Hypertension 
 hypertension_snomed = codelist_from_csv(
     "codelists/nhsd-primary-care-domain-refsets-hyp_cod.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 hypertension_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-hypertension_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 hypertension_drugs_dmd = codelist_from_csv(
     "codelists/user-elsie_horne-hypertension_drugs_dmd.csv",
-    column="dmd_id"
+    column="dmd_id",
+    system="dmd"
 )
 
 ### Diabetes 
 diabetes_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-diabetes_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 diabetes_drugs_dmd = codelist_from_csv(
     "codelists/user-elsie_horne-diabetes_drugs_dmd.csv",
-    column="dmd_id"
+    column="dmd_id",
+    system="dmd"
 )
 diabetes_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-diabetes_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )   
 
 ### Obesity 
 obesity_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-bmi_obesity_snomed.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 obesity_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-bmi_obesity_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 bmi_primis = codelist_from_csv(
     "codelists/primis-covid19-vacc-uptake-bmi.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 
 ### Chronic obstructive pulmonary disease (COPD) 
 copd_ctv3 = codelist_from_csv(
     "codelists/opensafely-current-copd.csv",
-    column="CTV3ID"
+    column="CTV3ID",
+    system="ctv3"
 )
 copd_icd10 = codelist_from_csv(
     "codelists/opensafely-copd-secondary-care.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 
 ### Acute myocardial infarction 
 ami_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-ami_snomed.csv",
     column="code",
+    system="snomed"
 )
 ami_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-ami_icd10.csv",
     column="code",
+    system="icd10"
 )
 ami_prior_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-ami_prior_icd10.csv",
-    column="code"
+    column="code",
+    system="icd10"
 )
 
 ### Ischaemic stroke 
 stroke_isch_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-stroke_isch_snomed.csv",
     column="code",
+    system="snomed"
 )
 stroke_isch_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-stroke_isch_icd10.csv",  
     column="code",
+    system="icd10"
 )
 
 ### Depression
 depression_snomed = codelist_from_csv(
     "codelists/user-hjforbes-depression-symptoms-and-diagnoses.csv",
-    column="code"
+    column="code",
+    system="snomed"
 )
 depression_icd10 = codelist_from_csv(
     "codelists/user-kurttaylor-depression_icd10.csv",
     column="code",
+    system="icd10"
 )
 
 # Outcomes ---------------------------------------------------------------------
@@ -413,10 +484,12 @@ depression_icd10 = codelist_from_csv(
 stroke_sahhs_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-stroke_sah_hs_snomed.csv",
     column="code",
+    system="snomed"
 )
 stroke_sahhs_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-stroke_sah_hs_icd10.csv",
     column="code",
+    system="icd10"
 )
 
 # Project specific covariates --------------------------------------------------
@@ -429,10 +502,12 @@ stroke_icd10 = stroke_isch_icd10 + stroke_sahhs_icd10
 other_ae_snomed = codelist_from_csv(
     "codelists/user-tomsrenin-other_art_embol.csv",
     column="code",
+    system="snomed"
 )
 other_ae_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-other_arterial_embolism_icd10.csv",
     column="code",
+    system="icd10"
 )
 
 ### Venous thromboembolism events (VTE)
@@ -440,61 +515,74 @@ other_ae_icd10 = codelist_from_csv(
 dvt_nonpreg_snomed = codelist_from_csv(
     "codelists/user-tomsrenin-dvt_main.csv",    
     column="code",
+    system="snomed"
 )
 dvt_preg_snomed = codelist_from_csv(
     "codelists/user-tomsrenin-dvt-preg.csv",   
     column="code",
+    system="snomed"
 )
 dvt_snomed = dvt_nonpreg_snomed + dvt_preg_snomed
 dvt_nonpreg_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-dvt_dvt_icd10.csv",   
     column="code",
+    system="icd10"
 )
 dvt_preg_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-dvt_pregnancy_icd10.csv",   
     column="code",
+    system="icd10"
 )
 dvt_icd10 = dvt_nonpreg_icd10 + dvt_preg_icd10
 #### Intracranial venous thrombosis (ICVT) [includes during pregnancy]
 icvt_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-dvt_icvt_snomed.csv",    
     column="code",
+    system="snomed"
 )
 icvt_nonpreg_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-dvt_icvt_icd10.csv",   
     column="code",
+    system="icd10"
 )
 icvt_preg_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-icvt_pregnancy_icd10.csv",  
     column="code",
+    system="icd10"
 )
 icvt_icd10 = icvt_nonpreg_icd10 + icvt_preg_icd10
 #### Other deep vein thrombosis
 other_dvt_snomed = codelist_from_csv(
     "codelists/user-tomsrenin-dvt-other.csv",   
     column="code",
+    system="snomed"
 )
 other_dvt_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-other_dvt_icd10.csv",    
     column="code",
+    system="icd10"
 )
 #### Pulmonary embolism (PE)
 pe_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-pe_snomed.csv",    
     column="code",
+    system="snomed"
 )
 pe_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-pe_icd10.csv",    
     column="code",
+    system="icd10"
 )
 #### Portal vein thrombosis (PVT)
 pvt_snomed = codelist_from_csv(
     "codelists/user-tomsrenin-pvt.csv",   
     column="code",
+    system="snomed"
 )
 pvt_icd10 = codelist_from_csv(
     "codelists/user-elsie_horne-portal_vein_thrombosis_icd10.csv",  
     column="code",
+    system="icd10"
 )
 #### Venous thrombotic event (VTE)
 vte_snomed = dvt_snomed + icvt_snomed + other_dvt_snomed + pe_snomed + pvt_snomed
@@ -504,42 +592,84 @@ vte_icd10 = dvt_icd10 + icvt_icd10 + other_dvt_icd10 + pe_icd10 + pvt_icd10
 hf_snomed = codelist_from_csv(
     "codelists/user-elsie_horne-hf_snomed.csv",   
     column="code",
+    system="snomed"
 )
 hf_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-hf_icd10.csv",  
     column="code",
+    system="icd10"
 )
 
 ### Angina 
 angina_snomed = codelist_from_csv(
     "codelists/user-hjforbes-angina_snomed.csv",  
     column="code",
+    system="snomed"
 )
 angina_icd10 = codelist_from_csv(
     "codelists/user-RochelleKnight-angina_icd10.csv",   
     column="code",
+    system="icd10"
 )
 
 ### Lipid lowering medications 
 lipid_lowering_dmd = codelist_from_csv(
     "codelists/user-elsie_horne-lipid_lowering_dmd.csv",
     column="dmd_id",
+    system="dmd"
 )
 
 ### Antiplatelet medications 
 antiplatelet_dmd = codelist_from_csv(
     "codelists/user-elsie_horne-antiplatelet_dmd.csv",
     column="dmd_id",
+    system="dmd"
 )
 
 ### Anticoagulation medications 
 anticoagulant_dmd = codelist_from_csv(
     "codelists/user-elsie_horne-anticoagulant_dmd.csv",
     column="dmd_id",
+    system="dmd"
 )
 
 ### Combined oral contraceptive pill 
 #### cocp_dmd defined earlier for this project - see 'Quality assurance'
 
 ### Hormone replacement therapy 
-#### hrt_dmd defined earlier for this project - see 'Quality assurance'
\ No newline at end of file
+#### hrt_dmd defined earlier for this project - see 'Quality assurance'
+
+# Lazy loading -----------------------------------------------------------------
+
+## Move every codelist defined above into the registry; each is parsed on first access by
+## __getattr__ and memoized as a module attribute
+registry = {
+    name: value for name, value in list(globals().items()) if isinstance(value, LazyCodelist)
+}
+for name in registry:
+    del globals()[name]
+
+## `from codelists import *` still works, but loads every codelist
+__all__ = list(registry)
+
+## Codelists loaded by this action, in order of first access
+loaded = []
+
+def __getattr__(name):
+    if name not in registry:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = registry[name].load()
+    globals()[name] = value
+    loaded.append(name)
+    return value
+
+## Report which codelists the action touched (at exit only when DATASET_DEFINITION_REPORTS is set, e.g. for
+## local profiling; backend actions print nothing)
+def report_loaded():
+    print(
+        f"codelists: loaded {len(loaded)} of {len(registry)} ({', '.join(loaded)})",
+        file=sys.stderr
+    )
+
+if os.environ.get("DATASET_DEFINITION_REPORTS"):
+    atexit.register(report_loaded)
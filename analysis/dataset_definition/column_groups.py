@@ -0,0 +1,75 @@
+# Column groups for column-sharded extraction
+#
+# Each variable is assigned to the group of the largest backend table it reads (apcs and ons_deaths before
+# clinical_events, before medications, ...), so that a definition run with `-- --column-group NAME` adds
+# only the variables that scan that table. The groups run as independent extraction jobs (see
+# generate_column_grouped in create_project_actions.R) and
+# analysis/column_sharded_extract/column_sharded_extract.py merge-joins their outputs (which share the
+# population, and so the patient_ids) back into the wide dataset. Without --column-group every variable
+# is added.
+
+import argparse
+import dataclasses
+import sys
+
+# Groups in the order a variable is assigned to them; variables that read none of these tables (e.g. only
+# patients or index_dates) form the "patients" group
+
+column_group_tables = dict(
+    hospital=("apcs", "ons_deaths", "emergency_care_attendances", "ethnicity_from_sus"),
+    clinical_events=("clinical_events",),
+    medications=("medications",),
+    vaccinations=("vaccinations", "occupation_on_covid_vaccine_record"),
+    tests=("sgss_covid_all_tests",),
+    registrations=("practice_registrations", "addresses", "appointments"),
+)
+
+column_group_names = (*column_group_tables, "patients")
+
+# Backend tables read by a series: the table nodes reachable from its query model node (the nodes are
+# frozen dataclasses)
+
+def series_tables(series):
+    tables, seen, stack = set(), set(), [series._qm_node]
+    while stack:
+        node = stack.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if type(node).__name__ in ("SelectTable", "SelectPatientTable"):
+            tables.add(node.name)
+        for field in dataclasses.fields(node):
+            value = getattr(node, field.name)
+            if isinstance(value, dict):
+                value = value.values()
+            elif not isinstance(value, (tuple, list, frozenset, set)):
+                value = [value]
+            stack.extend(child for child in value if dataclasses.is_dataclass(child) and not isinstance(child, type))
+    return(tables)
+
+def column_group(series):
+    tables = series_tables(series)
+    for group, group_tables in column_group_tables.items():
+        if tables.intersection(group_tables):
+            return(group)
+    return("patients")
+
+# Variable names by group, for a mapping of variable names to series
+
+def column_groups(variables):
+    groups = {}
+    for name, series in variables.items():
+        groups.setdefault(column_group(series), []).append(name)
+    return(groups)
+
+def current_column_group():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--column-group", choices=column_group_names, default=None)
+    args, _ = parser.parse_known_args(sys.argv[1:])
+    return(args.column_group)
+
+# Whether a variable belongs in the dataset being extracted (always, without --column-group)
+
+def in_column_group(series):
+    group = current_column_group()
+    return(group is None or column_group(series) == group)
@@ -1,90 +1,103 @@
+import os
+
+from datetime import timedelta
+
 from ehrql import (
     claim_permissions,
     create_dataset,
+    minimum_of,
 )
 # Bring table definitions from the TPP backend 
 from ehrql.tables.tpp import ( 
     patients, 
 )
 
-from ehrql.query_language import table_from_file, PatientFrame, Series
+# Dates for each cohort from the generate_dates action
+from index_dates import index_dates, index_date_variables
+
+from patient_shards import shard_population
 
-from datetime import date
+from column_groups import in_column_group
 
 claim_permissions("appointments")
 claim_permissions("sgss_covid_all_tests", "occupation_on_covid_vaccine_record")
 
 # Create dataset
+# Single cohort: generate_dataset(index_date, end_date_exp, end_date_out)
+# Landmark cohorts: generate_dataset(landmarks=landmark_windows(...)) adds every landmark's variables
+# to one dataset, suffixed with the landmark (e.g. cov_bin_ami_landmark_20200101); every landmark is
+# a full set of cohort queries, so N landmarks cost about N cohort extractions. reshape_landmarks.py
+# turns the wide output into one row per patient and landmark
 
-def generate_dataset(index_date, end_date_exp, end_date_out):
+def generate_dataset(index_date=None, end_date_exp=None, end_date_out=None, landmarks=None):
     dataset = create_dataset()
     
+    # Population restricted to one patient shard when run with `-- --shard k` (see patient_shards.py)
     dataset.define_population(
-        patients.date_of_birth.is_not_null()
+        shard_population(patients.date_of_birth.is_not_null())
     )
 
 # Configure dummy data
 
-    dataset.configure_dummy_data(population_size=10000)
+    # Dummy population size can be raised for local benchmarking (see analysis/benchmark)
+    dataset.configure_dummy_data(population_size=int(os.environ.get("DUMMY_POPULATION_SIZE", 10000)))
 
 # Import variables function
 
     from variables_cohorts import generate_variables
 
-    variables = generate_variables(index_date, end_date_exp, end_date_out)
+    if landmarks is not None:
+        cohort_windows = {f"_{landmark}": window for landmark, window in landmarks.items()}
+    else:
+        cohort_windows = {"": (index_date, end_date_exp, end_date_out)}
 
-    # Assign each variable to the dataset
+    for suffix, (cohort_index_date, cohort_end_date_exp, cohort_end_date_out) in cohort_windows.items():
+        variables = generate_variables(cohort_index_date, cohort_end_date_exp, cohort_end_date_out)
 
-    for var_name, var_value in variables.items():
-        setattr(dataset, var_name, var_value)
+        # Assign each variable to the dataset
 
-# Extract date variables for later pipelines
+        for var_name, var_value in variables.items():
+            add_variable(dataset, var_name + suffix, var_value)
 
-    @table_from_file("output/dataset_definition/index_dates.csv.gz")
-    
-    class index_dates(PatientFrame):
-    # Vaccine category and eligibility variables
-        vax_cat_jcvi_group = Series(str)
-        vax_date_eligible = Series(date)
-
-    # General COVID vaccination dates
-        vax_date_covid_1 = Series(date)
-        vax_date_covid_2 = Series(date)
-        vax_date_covid_3 = Series(date)
-
-    # Pfizer vaccine-specific dates
-        vax_date_Pfizer_1 = Series(date)
-        vax_date_Pfizer_2 = Series(date)
-        vax_date_Pfizer_3 = Series(date)
-
-    # AstraZeneca vaccine-specific dates
-        vax_date_AstraZeneca_1 = Series(date)
-        vax_date_AstraZeneca_2 = Series(date)
-        vax_date_AstraZeneca_3 = Series(date)
-
-    # Moderna vaccine-specific dates
-        vax_date_Moderna_1 = Series(date)
-        vax_date_Moderna_2 = Series(date)
-        vax_date_Moderna_3 = Series(date)
-
-    # Censoring date due to death
-        cens_date_death = Series(date)
+        # Record the landmark's dates (single cohort definitions set these themselves)
+
+        if suffix:
+            add_variable(dataset, "index_date" + suffix, cohort_index_date)
+            add_variable(dataset, "end_date_exposure" + suffix, cohort_end_date_exp)
+            add_variable(dataset, "end_date_outcome" + suffix, cohort_end_date_out)
 
     # Mapping all variables from index_dates to the dataset
-    dataset.vax_cat_jcvi_group = index_dates.vax_cat_jcvi_group
-    dataset.vax_date_eligible = index_dates.vax_date_eligible
-    dataset.vax_date_covid_1 = index_dates.vax_date_covid_1
-    dataset.vax_date_covid_2 = index_dates.vax_date_covid_2
-    dataset.vax_date_covid_3 = index_dates.vax_date_covid_3
-    dataset.vax_date_Pfizer_1 = index_dates.vax_date_Pfizer_1
-    dataset.vax_date_Pfizer_2 = index_dates.vax_date_Pfizer_2
-    dataset.vax_date_Pfizer_3 = index_dates.vax_date_Pfizer_3
-    dataset.vax_date_AstraZeneca_1 = index_dates.vax_date_AstraZeneca_1
-    dataset.vax_date_AstraZeneca_2 = index_dates.vax_date_AstraZeneca_2
-    dataset.vax_date_AstraZeneca_3 = index_dates.vax_date_AstraZeneca_3
-    dataset.vax_date_Moderna_1 = index_dates.vax_date_Moderna_1
-    dataset.vax_date_Moderna_2 = index_dates.vax_date_Moderna_2
-    dataset.vax_date_Moderna_3 = index_dates.vax_date_Moderna_3
-    dataset.cens_date_death = index_dates.cens_date_death
+    for var_name in index_date_variables:
+        add_variable(dataset, var_name, getattr(index_dates, var_name))
 
     return dataset
+
+# Add a variable to the dataset, unless the definition is run for another column group (see column_groups.py)
+
+def add_variable(dataset, var_name, var_value):
+    if in_column_group(var_value):
+        setattr(dataset, var_name, var_value)
+
+# Landmark windows: for each landmark date, the exposure window runs for exposure_days and the outcome
+# window to end_date; both are censored at death and at the first deregistration on or after the landmark
+# (as for the prevax, vax and unvax cohorts in dataset_definition_dates.py)
+
+def landmark_windows(landmark_dates, exposure_days, end_date):
+    from variable_helper_functions import first_deregistration_on_or_after
+
+    windows = {}
+    for landmark_date in landmark_dates:
+        # minimum_of turns the fixed date into a series, as for index_prevax in dataset_definition_dates.py
+        landmark_index = minimum_of(landmark_date, landmark_date)
+        cens_date_dereg = first_deregistration_on_or_after(landmark_index)
+        windows[f"landmark_{landmark_date:%Y%m%d}"] = (
+            landmark_index,
+            minimum_of(
+                index_dates.cens_date_death,
+                cens_date_dereg,
+                landmark_date + timedelta(days=exposure_days),
+                end_date,
+            ),
+            minimum_of(index_dates.cens_date_death, cens_date_dereg, end_date),
+        )
+    return windows
@@ -10,22 +10,32 @@ from ehrql import (
 
 from ehrql.tables.tpp import ( 
     patients, 
-    practice_registrations,
 )
 
+# Registration helper shared with generate_variables
+
+from variable_helper_functions import first_deregistration_on_or_after
+
+from patient_shards import shard_population
+
 from datetime import date
 
+import os
+
 claim_permissions("sgss_covid_all_tests", "occupation_on_covid_vaccine_record")
 
 # create dataset to create dates for different cohorts
 
 dataset = create_dataset()
 
+# Population restricted to one patient shard when run with `-- --shard k` (see patient_shards.py)
+
 dataset.define_population(
-    patients.date_of_birth.is_not_null()
+    shard_population(patients.date_of_birth.is_not_null())
 )
 
-dataset.configure_dummy_data(population_size=10000)
+# Dummy population size can be raised for local benchmarking (see analysis/benchmark)
+dataset.configure_dummy_data(population_size=int(os.environ.get("DUMMY_POPULATION_SIZE", 10000)))
 
 # Import study_dates dictionary
 
@@ -61,13 +71,7 @@ for var_name, var_value in jcvi_variables.items():
 
 dataset.index_prevax = minimum_of(date.fromisoformat(pandemic_start), date.fromisoformat(pandemic_start))
 
-cens_date_dereg_prevax = (
-    practice_registrations.where(practice_registrations.end_date.is_not_null())
-    .where(practice_registrations.end_date.is_on_or_after(dataset.index_prevax))
-    .sort_by(practice_registrations.end_date)
-    .first_for_patient()
-    .end_date
-)
+cens_date_dereg_prevax = first_deregistration_on_or_after(dataset.index_prevax)
 
 dataset.end_prevax_exposure = minimum_of(
     dataset.cens_date_death, 
@@ -91,13 +95,7 @@ dataset.index_vax = maximum_of(
     date.fromisoformat(delta_date)
 )
 
-cens_date_dereg_vax = (
-    practice_registrations.where(practice_registrations.end_date.is_not_null())
-    .where(practice_registrations.end_date.is_on_or_after(dataset.index_vax))
-    .sort_by(practice_registrations.end_date)
-    .first_for_patient()
-    .end_date
-)
+cens_date_dereg_vax = first_deregistration_on_or_after(dataset.index_vax)
 
 dataset.end_vax_exposure = minimum_of(
     dataset.cens_date_death, 
@@ -119,13 +117,7 @@ dataset.index_unvax = maximum_of(
     date.fromisoformat(delta_date)
 )
 
-cens_date_dereg_unvax = (
-    practice_registrations.where(practice_registrations.end_date.is_not_null())
-    .where(practice_registrations.end_date.is_on_or_after(dataset.index_unvax))
-    .sort_by(practice_registrations.end_date)
-    .first_for_patient()
-    .end_date
-)
+cens_date_dereg_unvax = first_deregistration_on_or_after(dataset.index_unvax)
 
 dataset.end_unvax_exposure = minimum_of(
     dataset.cens_date_death, 
@@ -0,0 +1,56 @@
+import argparse
+import sys
+
+from datetime import date
+
+from dataset_definition_cohorts import generate_dataset, landmark_windows
+
+from ehrql import claim_permissions
+claim_permissions("sgss_covid_all_tests", "occupation_on_covid_vaccine_record")
+
+# Import study_dates dictionary
+
+from variables_dates import study_dates
+
+# Landmark dates are passed as user arguments, e.g.
+# ehrql generate-dataset analysis/dataset_definition/dataset_definition_landmarks.py -- --landmarks 12
+# Defaults: monthly landmarks over the first year of the pandemic, a one year exposure window and
+# outcomes followed up to the last collection date
+# No scans are shared between landmarks (each has its own index date), so every landmark costs about
+# as much as one cohort extraction; there is no project action for this definition, and it is meant
+# for a few landmarks in local or sensitivity runs
+
+# Landmarks are every months apart, so the start date must be on or before the 28th to fall in every month
+
+def landmark_start(value):
+    start = date.fromisoformat(value)
+    if start.day > 28:
+        raise argparse.ArgumentTypeError(f"--start must be on or before the 28th of the month, not {value}")
+    return start
+
+# Other user arguments (e.g. --shard, --column-group) are read by the modules that use them
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--start", type=landmark_start, default=study_dates["pandemic_start"])
+parser.add_argument("--landmarks", type=int, default=12)
+parser.add_argument("--every", type=int, default=1, help="months between landmarks")
+parser.add_argument("--exposure-days", type=int, default=365)
+args, _ = parser.parse_known_args(sys.argv[1:])
+
+# Landmark i is i * every months after start
+
+def add_months(start, months):
+    month = start.month - 1 + months
+    return start.replace(year=start.year + month // 12, month=month % 12 + 1)
+
+landmark_dates = [add_months(args.start, i * args.every) for i in range(args.landmarks)]
+
+# Create dataset
+
+dataset = generate_dataset(
+    landmarks=landmark_windows(
+        landmark_dates,
+        exposure_days=args.exposure_days,
+        end_date=date.fromisoformat(study_dates["lcd_date"]),
+    )
+)
@@ -0,0 +1,19 @@
+from ehrql import create_dataset
+
+# Bring table definitions from the TPP backend 
+from ehrql.tables.tpp import ( 
+    patients, 
+)
+
+import os
+
+# Patient list for partitioned extraction (see patient_shards.py): the population shared by
+# dataset_definition_dates.py and the cohort definitions, with no variables
+
+dataset = create_dataset()
+
+dataset.define_population(
+    patients.date_of_birth.is_not_null()
+)
+
+dataset.configure_dummy_data(population_size=int(os.environ.get("DUMMY_POPULATION_SIZE", 10000)))
@@ -1,30 +1,20 @@
-from dataset_definition_cohorts import generate_dataset
+from dataset_definition_cohorts import generate_dataset, add_variable
 
-from ehrql.query_language import table_from_file, PatientFrame, Series
-
-from datetime import date
+from index_dates import cohort_dates
 
 from ehrql import claim_permissions 
 claim_permissions("sgss_covid_all_tests", "occupation_on_covid_vaccine_record")
 
-# extract index dates for prevax cohort from index_dates.csv
-
-@table_from_file("output/dataset_definition/index_dates.csv.gz")
-
-class index_dates(PatientFrame):
-    index_prevax = Series(date)
-    end_prevax_exposure = Series(date)
-    end_prevax_outcome = Series(date)
+# extract index dates for prevax cohort from index_dates.arrow
 
-index_date = index_dates.index_prevax
-end_date_exposure = index_dates.end_prevax_exposure
-end_date_outcome = index_dates.end_prevax_outcome
+index_date, end_date_exposure, end_date_outcome = cohort_dates("prevax")
 
 # Create dataset
 
 dataset = generate_dataset(index_date, end_date_exposure, end_date_outcome)
 
-dataset.index_date = index_date
-dataset.end_date_exposure = end_date_exposure
-dataset.end_date_outcome = end_date_outcome
+# Only added in the "patients" column group when run with `-- --column-group NAME` (see column_groups.py)
 
+add_variable(dataset, "index_date", index_date)
+add_variable(dataset, "end_date_exposure", end_date_exposure)
+add_variable(dataset, "end_date_outcome", end_date_outcome)
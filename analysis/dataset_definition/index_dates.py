@@ -0,0 +1,85 @@
+# Index dates handoff
+#
+# generate_dates writes output/dataset_definition/index_dates.arrow; the Arrow file carries its own
+# schema and is columnar, so only the columns declared in index_dates below are read. Import the frame
+# from this module (rather than redeclaring it) so that every dataset definition shares one loader.
+
+from ehrql.query_language import table_from_file, PatientFrame, Series
+
+from datetime import date
+
+import os
+
+# INDEX_DATES_PATH lets local tooling (e.g. analysis/benchmark) point at its own generate_dates output
+index_dates_path = os.environ.get("INDEX_DATES_PATH", "output/dataset_definition/index_dates.arrow")
+
+# Extract date variables for later pipelines
+
+@table_from_file(index_dates_path)
+
+class index_dates(PatientFrame):
+# Vaccine category and eligibility variables
+    vax_cat_jcvi_group = Series(str)
+    vax_date_eligible = Series(date)
+
+# General COVID vaccination dates
+    vax_date_covid_1 = Series(date)
+    vax_date_covid_2 = Series(date)
+    vax_date_covid_3 = Series(date)
+
+# Pfizer vaccine-specific dates
+    vax_date_Pfizer_1 = Series(date)
+    vax_date_Pfizer_2 = Series(date)
+    vax_date_Pfizer_3 = Series(date)
+
+# AstraZeneca vaccine-specific dates
+    vax_date_AstraZeneca_1 = Series(date)
+    vax_date_AstraZeneca_2 = Series(date)
+    vax_date_AstraZeneca_3 = Series(date)
+
+# Moderna vaccine-specific dates
+    vax_date_Moderna_1 = Series(date)
+    vax_date_Moderna_2 = Series(date)
+    vax_date_Moderna_3 = Series(date)
+
+# Censoring date due to death
+    cens_date_death = Series(date)
+
+# Cohort index and end dates
+    index_prevax = Series(date)
+    end_prevax_exposure = Series(date)
+    end_prevax_outcome = Series(date)
+    index_vax = Series(date)
+    end_vax_exposure = Series(date)
+    end_vax_outcome = Series(date)
+    index_unvax = Series(date)
+    end_unvax_exposure = Series(date)
+    end_unvax_outcome = Series(date)
+
+# Variables mapped from index_dates to every cohort dataset
+index_date_variables = [
+    "vax_cat_jcvi_group",
+    "vax_date_eligible",
+    "vax_date_covid_1",
+    "vax_date_covid_2",
+    "vax_date_covid_3",
+    "vax_date_Pfizer_1",
+    "vax_date_Pfizer_2",
+    "vax_date_Pfizer_3",
+    "vax_date_AstraZeneca_1",
+    "vax_date_AstraZeneca_2",
+    "vax_date_AstraZeneca_3",
+    "vax_date_Moderna_1",
+    "vax_date_Moderna_2",
+    "vax_date_Moderna_3",
+    "cens_date_death",
+]
+
+# Index date, end of exposure date and end of outcome date for a cohort (prevax, vax or unvax)
+
+def cohort_dates(cohort):
+    return (
+        getattr(index_dates, f"index_{cohort}"),
+        getattr(index_dates, f"end_{cohort}_exposure"),
+        getattr(index_dates, f"end_{cohort}_outcome"),
+    )
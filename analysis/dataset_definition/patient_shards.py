@@ -0,0 +1,33 @@
+# Patient shards for partitioned extraction
+#
+# analysis/partitioned_extract/partitioned_extract.py splits the population into K shards by a stable hash of
+# patient_id and writes output/dataset_definition/patient_shards.arrow (patient_id, shard). A dataset definition
+# run with the user arguments `-- --shard k` restricts its population to shard k, so the K shards can be
+# extracted concurrently (as local processes or as separate actions) and merged back in patient_id order.
+# Without --shard the population is unchanged and the shards file is not read.
+
+from ehrql.query_language import table_from_file, PatientFrame, Series
+
+import argparse
+import os
+import sys
+
+# PATIENT_SHARDS_PATH lets local tooling point at its own shards file
+patient_shards_path = os.environ.get("PATIENT_SHARDS_PATH", "output/dataset_definition/patient_shards.arrow")
+
+def current_shard():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--shard", type=int, default=None)
+    args, _ = parser.parse_known_args(sys.argv[1:])
+    return args.shard
+
+def shard_population(population):
+    shard = current_shard()
+    if shard is None:
+        return population
+
+    @table_from_file(patient_shards_path)
+    class patient_shards(PatientFrame):
+        shard = Series(int)
+
+    return population & (patient_shards.shard == shard)
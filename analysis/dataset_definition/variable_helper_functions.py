@@ -1,15 +1,65 @@
+import atexit
 import operator
-from ehrql import case, when
-from functools import reduce # for function building, e.g. any_of
+import os
+import sys
+from collections import namedtuple
+from datetime import date
+from ehrql import case, when, minimum_of
+from functools import reduce, wraps # for function building, e.g. any_of
 from ehrql.tables.tpp import (
     apcs, 
     clinical_events, 
     medications, 
     ons_deaths,
+    practice_registrations,
+    sgss_covid_all_tests,
     emergency_care_attendances,
     ethnicity_from_sus,
+    vaccinations,
 )
 
+# memoization: helper calls with the same table, codelist (by identity), date bounds and where-clause return
+# the same query node, so it is only built (and computed by the engine) once; ehrQL series are compared by
+# their query model node, other objects (e.g. codelists) by identity
+memo_cache = {}
+memo_stats = dict(calls=0, collapsed=0)
+
+def memo_key(value):
+    if value is None or isinstance(value, (str, int, float, bool, date)):
+        return value
+    node = getattr(value, "_qm_node", None)
+    if node is not None:
+        return ("node", node)
+    return ("id", id(value))
+
+def memoize(helper):
+    @wraps(helper)
+    def memoized_helper(*args, **kwargs):
+        key = (
+            helper.__name__,
+            tuple(memo_key(arg) for arg in args),
+            tuple((name, memo_key(value)) for name, value in sorted(kwargs.items())),
+        )
+        memo_stats["calls"] += 1
+        if key in memo_cache:
+            memo_stats["collapsed"] += 1
+        else:
+            # keep the arguments alive so that their ids cannot be reused by other objects
+            memo_cache[key] = (helper(*args, **kwargs), args, kwargs)
+        return memo_cache[key][0]
+    return memoized_helper
+
+# reported at exit only when DATASET_DEFINITION_REPORTS is set (e.g. for local profiling)
+def report_memo_stats():
+    print(
+        f"variable helpers: {memo_stats['calls']} calls, {memo_stats['collapsed']} duplicates collapsed",
+        file=sys.stderr
+    )
+
+if os.environ.get("DATASET_DEFINITION_REPORTS"):
+    atexit.register(report_memo_stats)
+
+@memoize
 def ever_matching_event_clinical_ctv3_before(codelist, start_date, where=True):
     return(
         clinical_events.where(where)
@@ -17,6 +67,7 @@ def ever_matching_event_clinical_ctv3_before(codelist, start_date, where=True):
         .where(clinical_events.date.is_before(start_date))
     )
 
+@memoize
 def last_matching_event_clinical_ctv3_before(codelist, start_date, where=True):
     return(
         clinical_events.where(where)
@@ -26,6 +77,7 @@ def last_matching_event_clinical_ctv3_before(codelist, start_date, where=True):
         .last_for_patient()
     )
 
+@memoize
 def last_matching_event_clinical_snomed_before(codelist, start_date, where=True):
     return(
         clinical_events.where(where)
@@ -35,6 +87,7 @@ def last_matching_event_clinical_snomed_before(codelist, start_date, where=True)
         .last_for_patient()
     )
 
+@memoize
 def last_matching_med_dmd_before(codelist, start_date, where=True):
     return(
         medications.where(where)
@@ -44,6 +97,7 @@ def last_matching_med_dmd_before(codelist, start_date, where=True):
         .last_for_patient()
     )
 
+@memoize
 def last_matching_event_apc_before(codelist, start_date, only_prim_diagnoses=False, where=True):
     query = apcs.where(where).where(apcs.admission_date.is_before(start_date))
     if only_prim_diagnoses:
@@ -54,28 +108,155 @@ def last_matching_event_apc_before(codelist, start_date, only_prim_diagnoses=Fal
         query = query.where(apcs.all_diagnoses.contains_any_of(codelist))
     return query.sort_by(apcs.admission_date).last_for_patient()
 
+# exists-only helpers: the same filters as the last_matching_* helpers, but the event frame is tested with
+# exists_for_patient() directly, so no per-patient sort is built when only existence is used
+@memoize
+def has_matching_event_clinical_ctv3_before(codelist, start_date, where=True):
+    return ever_matching_event_clinical_ctv3_before(codelist, start_date, where).exists_for_patient()
+
+@memoize
+def has_matching_event_clinical_snomed_before(codelist, start_date, where=True):
+    return(
+        clinical_events.where(where)
+        .where(clinical_events.snomedct_code.is_in(codelist))
+        .where(clinical_events.date.is_before(start_date))
+        .exists_for_patient()
+    )
+
+@memoize
+def has_matching_med_dmd_before(codelist, start_date, where=True):
+    return(
+        medications.where(where)
+        .where(medications.dmd_code.is_in(codelist))
+        .where(medications.date.is_before(start_date))
+        .exists_for_patient()
+    )
+
+@memoize
+def has_matching_event_apc_before(codelist, start_date, only_prim_diagnoses=False, where=True):
+    query = apcs.where(where).where(apcs.admission_date.is_before(start_date))
+    if only_prim_diagnoses:
+        query = query.where(
+            apcs.primary_diagnosis.is_in(codelist)
+        )
+    else:
+        query = query.where(apcs.all_diagnoses.contains_any_of(codelist))
+    return query.exists_for_patient()
+
+@memoize
+def has_matching_event_clinical_snomed_between(codelist, start_date, end_date, where=True):
+    return(
+        clinical_events.where(where)
+        .where(clinical_events.snomedct_code.is_in(codelist))
+        .where(clinical_events.date.is_on_or_between(start_date, end_date))
+        .exists_for_patient()
+    )
+
+@memoize
+def has_matching_med_dmd_between(codelist, start_date, end_date, where=True):
+    return(
+        medications.where(where)
+        .where(medications.dmd_code.is_in(codelist))
+        .where(medications.date.is_on_or_between(start_date, end_date))
+        .exists_for_patient()
+    )
+
+# batched history scans: one filtered pass over the event table for a dict of name -> codelist
+# sharing a single cut-off date; returns name -> History(exists, date) where date is the last match
+History = namedtuple("History", ["exists", "date"])
+
+# helper function: union of several codelists, preserving order and dropping duplicate codes
+def combine_codelists(codelists):
+    return list(dict.fromkeys(code for codelist in codelists for code in codelist))
+
+def last_matching_events_clinical_snomed_before(codelists, start_date, where=True):
+    events = (
+        clinical_events.where(where)
+        .where(clinical_events.snomedct_code.is_in(combine_codelists(codelists.values())))
+        .where(clinical_events.date.is_before(start_date))
+    )
+    history = {}
+    for name, codelist in codelists.items():
+        matching = events.where(events.snomedct_code.is_in(codelist))
+        history[name] = History(matching.exists_for_patient(), matching.date.maximum_for_patient())
+    return history
+
+def last_matching_meds_dmd_before(codelists, start_date, where=True):
+    meds = (
+        medications.where(where)
+        .where(medications.dmd_code.is_in(combine_codelists(codelists.values())))
+        .where(medications.date.is_before(start_date))
+    )
+    history = {}
+    for name, codelist in codelists.items():
+        matching = meds.where(meds.dmd_code.is_in(codelist))
+        history[name] = History(matching.exists_for_patient(), matching.date.maximum_for_patient())
+    return history
+
+def last_matching_events_apc_before(codelists, start_date, where=True):
+    spells = (
+        apcs.where(where)
+        .where(apcs.all_diagnoses.contains_any_of(combine_codelists(codelists.values())))
+        .where(apcs.admission_date.is_before(start_date))
+    )
+    history = {}
+    for name, codelist in codelists.items():
+        matching = spells.where(spells.all_diagnoses.contains_any_of(codelist))
+        history[name] = History(matching.exists_for_patient(), matching.admission_date.maximum_for_patient())
+    return history
+
 # helper function
 def any_of(conditions):
     return reduce(operator.or_, conditions)
 
+# emergency care diagnoses: attendances record up to 24 diagnoses in diagnosis_01 ... diagnosis_24;
+# ehrQL has no long view of these columns, so ec_diagnosis_is_in ORs one is_in test per column
+ec_diagnosis_columns = [f"diagnosis_{i:02d}" for i in range(1, 25)]
+
+def ec_diagnosis_is_in(codelist):
+    codes = list(codelist)
+    return any_of(
+        getattr(emergency_care_attendances, column_name).is_in(codes) for column_name in ec_diagnosis_columns
+    )
+
+@memoize
 def last_matching_event_ec_snomed_before(codelist, start_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(ec_diagnosis_is_in(codelist))
         .where(emergency_care_attendances.arrival_date.is_before(start_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .last_for_patient()
     )
 
+# death classification: ons_deaths holds one death record per patient. Each codelist is tested against its
+# causes of death once (death_cause_is_in is memoized), and classify_deaths gives name -> death date if the
+# death matched, so the windows of each cohort or landmark only compare dates against the same death row
+DeathRecord = namedtuple("DeathRecord", ["date", "cause_dates"])
+
+@memoize
+def death_cause_is_in(codelist):
+    return ons_deaths.cause_of_death_is_in(codelist)
+
+def classify_deaths(codelists):
+    return DeathRecord(
+        ons_deaths.date,
+        {
+            name: case(when(death_cause_is_in(codelist)).then(ons_deaths.date))
+            for name, codelist in codelists.items()
+        },
+    )
+
+def death_date_between(cause_date, start_date, end_date):
+    return case(when(cause_date.is_on_or_between(start_date, end_date)).then(cause_date))
+
+@memoize
 def matching_death_before(codelist, start_date, where=True):
     return(
-        ons_deaths.cause_of_death_is_in(codelist)  & ons_deaths.date.is_before(start_date)
+        death_cause_is_in(codelist)  & ons_deaths.date.is_before(start_date)
     )
 
+@memoize
 def last_matching_event_clinical_snomed_between(codelist, start_date, end_date, where=True):
     return(
         clinical_events.where(where)
@@ -85,6 +266,7 @@ def last_matching_event_clinical_snomed_between(codelist, start_date, end_date,
         .last_for_patient()
     )
 
+@memoize
 def last_matching_med_dmd_between(codelist, start_date, end_date, where=True):
     return(
         medications.where(where)
@@ -94,6 +276,7 @@ def last_matching_med_dmd_between(codelist, start_date, end_date, where=True):
         .last_for_patient()
     )
 
+@memoize
 def first_matching_event_clinical_ctv3_between(codelist, start_date, end_date, where=True):
     return(
         clinical_events.where(where)
@@ -103,6 +286,7 @@ def first_matching_event_clinical_ctv3_between(codelist, start_date, end_date, w
         .first_for_patient()
     )
 
+@memoize
 def first_matching_event_clinical_snomed_between(codelist, start_date, end_date, where=True):
     return(
         clinical_events.where(where)
@@ -112,6 +296,7 @@ def first_matching_event_clinical_snomed_between(codelist, start_date, end_date,
         .first_for_patient()
     )
 
+@memoize
 def first_matching_med_dmd_between(codelist, start_date, end_date, where=True):
     return(
         medications.where(where)
@@ -121,6 +306,7 @@ def first_matching_med_dmd_between(codelist, start_date, end_date, where=True):
         .first_for_patient()
     )
 
+@memoize
 def first_matching_event_apc_between(codelist, start_date, end_date, only_prim_diagnoses=False, where=True):
     query = apcs.where(where).where(apcs.admission_date.is_on_or_between(start_date, end_date))
     if only_prim_diagnoses:
@@ -131,23 +317,211 @@ def first_matching_event_apc_between(codelist, start_date, end_date, only_prim_d
         query = query.where(apcs.all_diagnoses.contains_any_of(codelist))
     return query.sort_by(apcs.admission_date).first_for_patient()
 
+@memoize
 def first_matching_event_ec_snomed_between(codelist, start_date, end_date, where=True):
-    conditions = [
-        getattr(emergency_care_attendances, column_name).is_in(codelist)
-        for column_name in ([f"diagnosis_{i:02d}" for i in range(1, 25)])
-    ]
     return(
         emergency_care_attendances.where(where)
-        .where(any_of(conditions))
+        .where(ec_diagnosis_is_in(codelist))
         .where(emergency_care_attendances.arrival_date.is_on_or_between(start_date, end_date))
         .sort_by(emergency_care_attendances.arrival_date)
         .first_for_patient()
     )
 
+@memoize
 def matching_death_between(codelist, start_date, end_date, where=True):
     return(
-        ons_deaths.cause_of_death_is_in(codelist) & ons_deaths.date.is_on_or_between(start_date, end_date)
+        death_cause_is_in(codelist) & ons_deaths.date.is_on_or_between(start_date, end_date)
+    )
+
+# date-only helpers: when only the event date is used, the first/last matching date is taken with a
+# minimum_for_patient()/maximum_for_patient() aggregate instead of sorting and picking a row
+@memoize
+def first_matching_date_clinical_ctv3_between(codelist, start_date, end_date, where=True):
+    return(
+        clinical_events.where(where)
+        .where(clinical_events.ctv3_code.is_in(codelist))
+        .where(clinical_events.date.is_on_or_between(start_date, end_date))
+        .date.minimum_for_patient()
+    )
+
+@memoize
+def first_matching_date_clinical_snomed_between(codelist, start_date, end_date, where=True):
+    return(
+        clinical_events.where(where)
+        .where(clinical_events.snomedct_code.is_in(codelist))
+        .where(clinical_events.date.is_on_or_between(start_date, end_date))
+        .date.minimum_for_patient()
+    )
+
+@memoize
+def first_matching_date_med_dmd_between(codelist, start_date, end_date, where=True):
+    return(
+        medications.where(where)
+        .where(medications.dmd_code.is_in(codelist))
+        .where(medications.date.is_on_or_between(start_date, end_date))
+        .date.minimum_for_patient()
+    )
+
+@memoize
+def first_matching_date_apc_between(codelist, start_date, end_date, only_prim_diagnoses=False, where=True):
+    query = apcs.where(where).where(apcs.admission_date.is_on_or_between(start_date, end_date))
+    if only_prim_diagnoses:
+        query = query.where(
+            apcs.primary_diagnosis.is_in(codelist)
+        )
+    else:
+        query = query.where(apcs.all_diagnoses.contains_any_of(codelist))
+    return query.admission_date.minimum_for_patient()
+
+@memoize
+def last_matching_date_clinical_snomed_before(codelist, start_date, where=True):
+    return(
+        clinical_events.where(where)
+        .where(clinical_events.snomedct_code.is_in(codelist))
+        .where(clinical_events.date.is_before(start_date))
+        .date.maximum_for_patient()
+    )
+
+@memoize
+def last_matching_date_clinical_snomed_between(codelist, start_date, end_date, where=True):
+    return(
+        clinical_events.where(where)
+        .where(clinical_events.snomedct_code.is_in(codelist))
+        .where(clinical_events.date.is_on_or_between(start_date, end_date))
+        .date.maximum_for_patient()
+    )
+
+@memoize
+def last_matching_date_med_dmd_before(codelist, start_date, where=True):
+    return(
+        medications.where(where)
+        .where(medications.dmd_code.is_in(codelist))
+        .where(medications.date.is_before(start_date))
+        .date.maximum_for_patient()
+    )
+
+# practice registrations: registration questions for any number of dates (index dates, cohort start dates,
+# landmarks) are answered from the same registration spans; deregistrations are the spans with an end date
+deregistrations = practice_registrations.where(practice_registrations.end_date.is_not_null())
+
+@memoize
+def registered_throughout(start_date, end_date):
+    return practice_registrations.spanning(start_date, end_date).exists_for_patient()
+
+@memoize
+def first_deregistration_on_or_after(start_date):
+    return(
+        deregistrations.where(deregistrations.end_date.is_on_or_after(start_date))
+        .end_date.minimum_for_patient()
+    )
+
+@memoize
+def registration_on(date):
+    return practice_registrations.for_patient_on(date)
+
+# COVID-19 episodes: each source of COVID-19 evidence (positive SGSS test, primary care CTV3 code, hospital
+# admission with COVID-19 as primary or secondary diagnosis) is filtered on its codes once, and the history flag
+# (evidence before index_date), first exposure date (on or between index_date and end_date_exp, including death)
+# and hospitalisation category (COVID-19 primary diagnosis admission within 28 days of exposure) share those frames;
+# death_date is the COVID-19 entry of a classify_deaths record
+CovidEpisode = namedtuple("CovidEpisode", ["history", "exp_date", "hospitalised"])
+
+def covid_episode(primary_care_codes, hospital_codes, index_date, end_date_exp, death_date=None):
+    if death_date is None:
+        death_date = classify_deaths(dict(covid=hospital_codes)).cause_dates["covid"]
+    tests = sgss_covid_all_tests.where(sgss_covid_all_tests.is_positive)
+    gp_events = clinical_events.where(clinical_events.ctv3_code.is_in(primary_care_codes))
+    spells = apcs.where(
+        (apcs.primary_diagnosis.is_in(hospital_codes)) |
+        (apcs.secondary_diagnosis.is_in(hospital_codes))
+    )
+
+    history = (
+        tests.where(tests.specimen_taken_date.is_before(index_date)).exists_for_patient() |
+        gp_events.where(gp_events.date.is_before(index_date)).exists_for_patient() |
+        spells.where(spells.admission_date.is_before(index_date)).exists_for_patient()
+    )
+
+    exp_date = minimum_of(
+        tests.where(tests.specimen_taken_date.is_on_or_between(index_date, end_date_exp))
+        .specimen_taken_date.minimum_for_patient(),
+        gp_events.where(gp_events.date.is_on_or_between(index_date, end_date_exp))
+        .date.minimum_for_patient(),
+        spells.where(spells.admission_date.is_on_or_between(index_date, end_date_exp))
+        .admission_date.minimum_for_patient(),
+        death_date_between(death_date, index_date, end_date_exp),
+    )
+
+    hospital_date = (
+        spells.where(spells.primary_diagnosis.is_in(hospital_codes))
+        .where(spells.admission_date.is_on_or_after(exp_date))
+        .admission_date.minimum_for_patient()
+    )
+    hospitalised = case(
+        when(
+            (exp_date.is_not_null()) &
+            (hospital_date.is_not_null()) &
+            ((hospital_date - exp_date).days >= 0) &
+            ((hospital_date - exp_date).days < 29)
+            ).then("hospitalised"),
+        when(exp_date.is_not_null()).then("non_hospitalised"),
+        when(exp_date.is_null()).then("no_infection")
+    )
+    return CovidEpisode(history, exp_date, hospitalised)
+
+# outcome definitions: outcomes maps each outcome name to dict(gp=snomed, apc=icd10, death=icd10) codelists;
+# clinical_events and apcs are each filtered once on the union of all outcome codes within the window and then
+# split per outcome, giving tmp_out_date_{name}_gp/_apc/_death (for Venn diagrams) and the combined out_date_{name};
+# death dates come from a classify_deaths record with one entry per outcome name
+def generate_outcome_variables(outcomes, start_date, end_date, deaths=None):
+    if deaths is None:
+        deaths = classify_deaths({name: outcome["death"] for name, outcome in outcomes.items()})
+    gp_events = (
+        clinical_events.where(clinical_events.snomedct_code.is_in(
+            combine_codelists(outcome["gp"] for outcome in outcomes.values())
+        ))
+        .where(clinical_events.date.is_on_or_between(start_date, end_date))
+    )
+    spells = (
+        apcs.where(apcs.all_diagnoses.contains_any_of(
+            combine_codelists(outcome["apc"] for outcome in outcomes.values())
+        ))
+        .where(apcs.admission_date.is_on_or_between(start_date, end_date))
+    )
+    outcome_variables = {}
+    for name, outcome in outcomes.items():
+        date_gp = gp_events.where(gp_events.snomedct_code.is_in(outcome["gp"])).date.minimum_for_patient()
+        date_apc = spells.where(spells.all_diagnoses.contains_any_of(outcome["apc"])).admission_date.minimum_for_patient()
+        date_death = death_date_between(deaths.cause_dates[name], start_date, end_date)
+        outcome_variables[f"tmp_out_date_{name}_gp"] = date_gp
+        outcome_variables[f"tmp_out_date_{name}_apc"] = date_apc
+        outcome_variables[f"tmp_out_date_{name}_death"] = date_death
+        outcome_variables[f"out_date_{name}"] = minimum_of(date_gp, date_apc, date_death)
+    return outcome_variables
+
+# vaccination dose sequencing: the records for every group (target disease overall, plus one group per product)
+# come from one shared filter of the vaccinations table; each group yields its first n dose dates and a dose count
+DoseSequence = namedtuple("DoseSequence", ["dates", "count"])
+
+def vaccination_dose_sequence(target_disease, products, start_date, n_doses=3):
+    records = vaccinations.where(
+        vaccinations.target_disease.contains(target_disease) |
+        vaccinations.product_name.is_in(list(products.values()))
     )
+    groups = {"covid": records.where(records.target_disease.contains(target_disease))}
+    for product_id, product_name in products.items():
+        groups[product_id] = records.where(records.product_name == product_name)
+    sequence = {}
+    for group, doses in groups.items():
+        dates = []
+        for dose in range(n_doses):
+            if dose == 0:
+                later_doses = doses.where(doses.date.is_on_or_after(start_date))
+            else:
+                later_doses = doses.where(doses.date > dates[-1])  # Exclude the earlier dates
+            dates.append(later_doses.date.minimum_for_patient())
+        sequence[group] = DoseSequence(dates, doses.count_for_patient())
+    return sequence
 
 # filter a codelist based on whether its values included a specified set of allowed values (include)
 def filter_codes_by_category(codelist, include):
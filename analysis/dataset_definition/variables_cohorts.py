@@ -8,183 +8,233 @@ from ehrql import (
 # Bring table definitions from the TPP backend 
 from ehrql.tables.tpp import ( 
     patients, 
-    practice_registrations, 
     addresses, 
     appointments, 
     occupation_on_covid_vaccine_record,
-    sgss_covid_all_tests,
     ethnicity_from_sus,
     apcs, 
     clinical_events, 
     ons_deaths,
 )
 
-# Codelists from codelists.py (which pulls all variables from the codelist folder)
-from codelists import *
+# Codelists from codelists.py (loaded on first access, so only the codelists imported here are parsed)
+from codelists import (
+    # Exposures
+    covid_codes,
+    covid_primary_care_code,
+    covid_primary_care_positive_test,
+    covid_primary_care_sequalae,
+    # Quality assurance
+    prostate_cancer_snomed,
+    prostate_cancer_icd10,
+    pregnancy_snomed,
+    cocp_dmd,
+    hrt_dmd,
+    # Core covariates
+    ethnicity_snomed,
+    smoking_clear,
+    dementia_snomed,
+    dementia_icd10,
+    liver_disease_snomed,
+    liver_disease_icd10,
+    ckd_snomed,
+    ckd_icd10,
+    cancer_snomed,
+    cancer_icd10,
+    hypertension_snomed,
+    hypertension_icd10,
+    hypertension_drugs_dmd,
+    diabetes_snomed,
+    diabetes_icd10,
+    diabetes_drugs_dmd,
+    obesity_snomed,
+    obesity_icd10,
+    copd_ctv3,
+    copd_icd10,
+    ami_snomed,
+    ami_icd10,
+    ami_prior_icd10,
+    depression_snomed,
+    depression_icd10,
+    # Outcomes
+    stroke_sahhs_snomed,
+    stroke_sahhs_icd10,
+    # Project specific covariates
+    stroke_snomed,
+    stroke_icd10,
+    other_ae_snomed,
+    other_ae_icd10,
+    vte_snomed,
+    vte_icd10,
+    hf_snomed,
+    hf_icd10,
+    angina_snomed,
+    angina_icd10,
+    lipid_lowering_dmd,
+    antiplatelet_dmd,
+    anticoagulant_dmd,
+)
 
 # Call functions from variable_helper_functions
 from variable_helper_functions import (
     ever_matching_event_clinical_ctv3_before,
-    first_matching_event_clinical_ctv3_between,
-    first_matching_event_clinical_snomed_between,
-    first_matching_event_apc_between,
-    matching_death_between,
     last_matching_event_clinical_ctv3_before,
-    last_matching_event_clinical_snomed_before,
-    last_matching_med_dmd_before,
-    last_matching_event_apc_before,
-    matching_death_before,
+    last_matching_events_clinical_snomed_before,
+    last_matching_meds_dmd_before,
+    last_matching_events_apc_before,
+    has_matching_event_clinical_ctv3_before,
+    covid_episode,
+    classify_deaths,
+    registered_throughout,
+    first_deregistration_on_or_after,
+    registration_on,
     filter_codes_by_category,
     get_latest_ethnicity,
+    generate_outcome_variables,
+)
+
+# Outcome registry: codelists used to find each outcome in primary care (gp), secondary care (apc) and
+# death records (death); add an entry here to extract tmp_out_date_{name}_* and out_date_{name}
+outcomes = dict(
+    ### Acute myocardial infarction (AMI)
+    ami = dict(
+        gp = ami_snomed,
+        apc = ami_icd10,
+        death = ami_icd10,
+    ),
+    ### Subarachnoid haemorrhage and haemorrhagic stroke
+    stroke_sahhs = dict(
+        gp = stroke_sahhs_snomed,
+        apc = stroke_sahhs_icd10,
+        death = stroke_sahhs_icd10,
+    ),
+)
+
+# COVID-19 primary care codes, combined once rather than on every call of generate_variables
+covid_primary_care = (
+    covid_primary_care_code +
+    covid_primary_care_positive_test +
+    covid_primary_care_sequalae
 )
 
+# Death classification: every cause-of-death codelist used below, tested once against the death record
+deaths = classify_deaths(dict(
+    covid = covid_codes,
+    **{name: outcome["death"] for name, outcome in outcomes.items()},
+))
+
 # Define generate variables function
 def generate_variables(index_date, end_date_exp, end_date_out):  
 
     ## Inclusion/exclusion criteria------------------------------------------------------------------------
 
     ### Registered for a minimum of 6 months prior to index date
-    inex_bin_6m_reg = (practice_registrations.spanning(
+    inex_bin_6m_reg = registered_throughout(
         index_date - days(180), index_date
-        )).exists_for_patient()
+        )
 
     ### Alive on the index date
     inex_bin_alive = (((patients.date_of_death.is_null()) | (patients.date_of_death.is_after(index_date))) & 
-    ((ons_deaths.date.is_null()) | (ons_deaths.date.is_after(index_date))))
+    ((deaths.date.is_null()) | (deaths.date.is_after(index_date))))
 
     ## Censoring criteria----------------------------------------------------------------------------------
 
     ### Deregistered
-    cens_date_dereg = (
-        practice_registrations.where(practice_registrations.end_date.is_not_null())
-        .where(practice_registrations.end_date.is_on_or_after(index_date))
-        .sort_by(practice_registrations.end_date)
-        .first_for_patient()
-        .end_date
-    )
+    cens_date_dereg = first_deregistration_on_or_after(index_date)
 
     ## Exposures-------------------------------------------------------------------------------------------
 
-    ### COVID-19
-    tmp_exp_date_covid_sgss = (
-        sgss_covid_all_tests.where(
-            sgss_covid_all_tests.specimen_taken_date.is_on_or_between(index_date, end_date_exp)
-        )
-        .where(sgss_covid_all_tests.is_positive)
-        .sort_by(sgss_covid_all_tests.specimen_taken_date)
-        .first_for_patient()
-        .specimen_taken_date
-    )
-    tmp_exp_date_covid_gp = (
-        clinical_events.where(
-            (clinical_events.ctv3_code.is_in(
-                covid_primary_care_code + 
-                covid_primary_care_positive_test +
-                covid_primary_care_sequalae)) &
-            clinical_events.date.is_on_or_between(index_date, end_date_exp)
-        )
-        .sort_by(clinical_events.date)
-        .first_for_patient()
-        .date
-    )
-    tmp_exp_date_covid_apc = (
-        apcs.where(
-            ((apcs.primary_diagnosis.is_in(covid_codes)) | 
-             (apcs.secondary_diagnosis.is_in(covid_codes))) & 
-            (apcs.admission_date.is_on_or_between(index_date, end_date_exp))
-        )
-        .sort_by(apcs.admission_date)
-        .first_for_patient()
-        .admission_date
-    )
-    tmp_exp_covid_death = matching_death_between(covid_codes, index_date, end_date_exp)
-    tmp_exp_date_death = ons_deaths.date
-    tmp_exp_date_covid_death = case(
-        when(tmp_exp_covid_death).then(tmp_exp_date_death)
-    )
-    
-    exp_date_covid = minimum_of(
-        tmp_exp_date_covid_sgss, 
-        tmp_exp_date_covid_gp,
-        tmp_exp_date_covid_apc,
-        tmp_exp_date_covid_death
+    ### COVID-19 (history and severity below come from the same episode)
+    covid = covid_episode(covid_primary_care, covid_codes, index_date, end_date_exp, deaths.cause_dates["covid"])
+    exp_date_covid = covid.exp_date
+
+    ## History scans---------------------------------------------------------------------------------------
+
+    ### Every codelist checked before the index date shares one pass per event table
+    history_gp = last_matching_events_clinical_snomed_before(
+        dict(
+            prostate_cancer = prostate_cancer_snomed,
+            pregnancy = pregnancy_snomed,
+            dementia = dementia_snomed,
+            liver_disease = liver_disease_snomed,
+            ckd = ckd_snomed,
+            cancer = cancer_snomed,
+            hypertension = hypertension_snomed,
+            diabetes = diabetes_snomed,
+            obesity = obesity_snomed,
+            ami = ami_snomed,
+            depression = depression_snomed,
+            stroke_all = stroke_snomed,
+            other_ae = other_ae_snomed,
+            vte = vte_snomed,
+            hf = hf_snomed,
+            angina = angina_snomed,
+        ),
+        index_date
+    )
+
+    history_med = last_matching_meds_dmd_before(
+        dict(
+            hrtcocp = cocp_dmd + hrt_dmd,
+            hypertension = hypertension_drugs_dmd,
+            diabetes = diabetes_drugs_dmd,
+            lipidmed = lipid_lowering_dmd,
+            antiplatelet = antiplatelet_dmd,
+            anticoagulant = anticoagulant_dmd,
+            cocp = cocp_dmd,
+            hrt = hrt_dmd,
+        ),
+        index_date
+    )
+
+    history_apc = last_matching_events_apc_before(
+        dict(
+            prostate_cancer = prostate_cancer_icd10,
+            dementia = dementia_icd10,
+            liver_disease = liver_disease_icd10,
+            ckd = ckd_icd10,
+            cancer = cancer_icd10,
+            hypertension = hypertension_icd10,
+            diabetes = diabetes_icd10,
+            obesity = obesity_icd10,
+            copd = copd_icd10,
+            ami = ami_icd10 + ami_prior_icd10,
+            depression = depression_icd10,
+            stroke_all = stroke_icd10,
+            other_ae = other_ae_icd10,
+            vte = vte_icd10,
+            hf = hf_icd10,
+            angina = angina_icd10,
+        ),
+        index_date
     )
 
     ## Quality assurance-----------------------------------------------------------------------------------
 
     ### Prostate cancer
     qa_bin_prostate_cancer = (
-        (last_matching_event_clinical_snomed_before(
-            prostate_cancer_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            prostate_cancer_icd10, index_date
-        ).exists_for_patient())
+        history_gp["prostate_cancer"].exists |
+        history_apc["prostate_cancer"].exists
     )
 
     ### Pregnancy
-    qa_bin_pregnancy = last_matching_event_clinical_snomed_before(
-        pregnancy_snomed, index_date
-    ).exists_for_patient()
+    qa_bin_pregnancy = history_gp["pregnancy"].exists
 
     ### Year of birth
     qa_num_birth_year = patients.date_of_birth.year
 
     ## COCP or heart medication
-    qa_bin_hrtcocp = last_matching_med_dmd_before(
-        cocp_dmd + hrt_dmd, index_date
-    ).exists_for_patient()
+    qa_bin_hrtcocp = history_med["hrtcocp"].exists
 
     ## Outcomes--------------------------------------------------------------------------------------------
 
-     ### Acute myocardial infarction (AMI)
-    tmp_out_date_ami_gp = (
-        first_matching_event_clinical_snomed_between(
-            ami_snomed, index_date, end_date_out
-            ).date
-    )
-    tmp_out_date_ami_apc = (
-        first_matching_event_apc_between(
-            ami_icd10, index_date, end_date_out
-            ).admission_date
-    )
-    tmp_out_date_ami_death = case(
-        when(
-            matching_death_between(ami_icd10, index_date, end_date_out)
-            ).then(ons_deaths.date)
-    )
-    out_date_ami = minimum_of(
-        tmp_out_date_ami_gp,
-        tmp_out_date_ami_apc,
-        tmp_out_date_ami_death
-    )
-
-    ### Subarachnoid haemorrhage and haemorrhagic stroke
-    tmp_out_date_stroke_sahhs_gp = (
-        first_matching_event_clinical_snomed_between(
-            stroke_sahhs_snomed, index_date, end_date_out
-            ).date
-    )
-    tmp_out_date_stroke_sahhs_apc = (
-        first_matching_event_apc_between(
-            stroke_sahhs_icd10, index_date, end_date_out
-            ).admission_date
-    )
-    tmp_out_date_stroke_sahhs_death = case(
-        when(
-            matching_death_between(stroke_sahhs_icd10, index_date, end_date_out)
-            ).then(ons_deaths.date)
-    )
-    out_date_stroke_sahhs = minimum_of(
-        tmp_out_date_stroke_sahhs_gp,
-        tmp_out_date_stroke_sahhs_apc,
-        tmp_out_date_stroke_sahhs_death
-    )
+    ### Outcome dates from primary care, secondary care and death, plus the combined date (see outcomes above)
+    outcome_variables = generate_outcome_variables(outcomes, index_date, end_date_out, deaths)
 
     ## Strata----------------------------------------------------------------------------------------------
 
     ### Region
-    strat_cat_region = practice_registrations.for_patient_on(index_date).practice_nuts1_region_name
+    strat_cat_region = registration_on(index_date).practice_nuts1_region_name
 
     ## Core covariates-------------------------------------------------------------------------------------
 
@@ -199,14 +249,17 @@ def generate_variables(index_date, end_date_exp, end_date_out):
     ### See https://www.opencodelists.org/codelist/opensafely/ethnicity-snomed-0removed/22911876/
     cov_cat_ethnicity = get_latest_ethnicity(index_date, ethnicity_snomed, grouping=6)
 
+    ### Address on the index date (shared by deprivation and care home status)
+    address = addresses.for_patient_on(index_date)
+
     ### Deprivation
     cov_cat_imd = case(
-        when((addresses.for_patient_on(index_date).imd_rounded >= 0) & 
-                (addresses.for_patient_on(index_date).imd_rounded < int(32844 * 1 / 5))).then("1 (most deprived)"),
-        when(addresses.for_patient_on(index_date).imd_rounded < int(32844 * 2 / 5)).then("2"),
-        when(addresses.for_patient_on(index_date).imd_rounded < int(32844 * 3 / 5)).then("3"),
-        when(addresses.for_patient_on(index_date).imd_rounded < int(32844 * 4 / 5)).then("4"),
-        when(addresses.for_patient_on(index_date).imd_rounded < int(32844 * 5 / 5)).then("5 (least deprived)"),
+        when((address.imd_rounded >= 0) & 
+                (address.imd_rounded < int(32844 * 1 / 5))).then("1 (most deprived)"),
+        when(address.imd_rounded < int(32844 * 2 / 5)).then("2"),
+        when(address.imd_rounded < int(32844 * 3 / 5)).then("3"),
+        when(address.imd_rounded < int(32844 * 4 / 5)).then("4"),
+        when(address.imd_rounded < int(32844 * 5 / 5)).then("5 (least deprived)"),
         otherwise="unknown",
     )
 
@@ -228,9 +281,9 @@ def generate_variables(index_date, end_date_exp, end_date_out):
 
     ### Care home status
     cov_bin_carehome = (
-        addresses.for_patient_on(index_date).care_home_is_potential_match |
-        addresses.for_patient_on(index_date).care_home_requires_nursing |
-        addresses.for_patient_on(index_date).care_home_does_not_require_nursing
+        address.care_home_is_potential_match |
+        address.care_home_requires_nursing |
+        address.care_home_does_not_require_nursing
     )
 
     # ### Consultation rate in 2019
@@ -257,252 +310,132 @@ def generate_variables(index_date, end_date_exp, end_date_out):
 
     ### Dementia
     cov_bin_dementia = (
-        (last_matching_event_clinical_snomed_before(
-            dementia_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            dementia_icd10, index_date
-        ).exists_for_patient())
+        history_gp["dementia"].exists |
+        history_apc["dementia"].exists
     )
 
     ### Liver disease
     cov_bin_liver_disease = (
-        (last_matching_event_clinical_snomed_before(
-            liver_disease_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            liver_disease_icd10, index_date
-        ).exists_for_patient())
+        history_gp["liver_disease"].exists |
+        history_apc["liver_disease"].exists
     )
 
     ### Chronic kidney disease (CKD)
     cov_bin_ckd = (
-        (last_matching_event_clinical_snomed_before(
-            ckd_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            ckd_icd10, index_date
-        ).exists_for_patient())
+        history_gp["ckd"].exists |
+        history_apc["ckd"].exists
     )
 
     ### Cancer
     cov_bin_cancer = (
-        (last_matching_event_clinical_snomed_before(
-            cancer_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            cancer_icd10, index_date
-        ).exists_for_patient())
+        history_gp["cancer"].exists |
+        history_apc["cancer"].exists
     )
 
     ### Hypertension
     cov_bin_hypertension = (
-        (last_matching_event_clinical_snomed_before(
-            hypertension_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_med_dmd_before(
-            hypertension_drugs_dmd, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            hypertension_icd10, index_date
-        ).exists_for_patient())
+        history_gp["hypertension"].exists |
+        history_med["hypertension"].exists |
+        history_apc["hypertension"].exists
     )
 
     ### Diabetes 
     cov_bin_diabetes = (
-        (last_matching_event_clinical_snomed_before(
-            diabetes_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_med_dmd_before(
-            diabetes_drugs_dmd, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            diabetes_icd10, index_date
-        ).exists_for_patient())
+        history_gp["diabetes"].exists |
+        history_med["diabetes"].exists |
+        history_apc["diabetes"].exists
     )
 
     ### Obesity 
     cov_bin_obesity = (
-        (last_matching_event_clinical_snomed_before(
-            obesity_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            obesity_icd10, index_date
-        ).exists_for_patient())
+        history_gp["obesity"].exists |
+        history_apc["obesity"].exists
     )
 
     ### Chronic obstructive pulmonary disease (COPD)
     cov_bin_copd = (
-        (last_matching_event_clinical_ctv3_before(
+        has_matching_event_clinical_ctv3_before(
             copd_ctv3, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            copd_icd10, index_date
-        ).exists_for_patient())
+        ) |
+        history_apc["copd"].exists
     )
 
     ### Acute myocardial infarction (AMI)
     cov_bin_ami = (
-        (last_matching_event_clinical_snomed_before(
-            ami_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            ami_icd10 + ami_prior_icd10, index_date
-        ).exists_for_patient())
+        history_gp["ami"].exists |
+        history_apc["ami"].exists
     )
 
     ### Depression
     cov_bin_depression = (
-        (last_matching_event_clinical_snomed_before(
-            depression_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            depression_icd10, index_date
-        ).exists_for_patient())
+        history_gp["depression"].exists |
+        history_apc["depression"].exists
     )
 
     # ### Ischaemic stroke
     # cov_bin_stroke_isch = (
-    #     (last_matching_event_clinical_snomed_before(
+    #     has_matching_event_clinical_snomed_before(
     #         stroke_isch_snomed, index_date
-    #     ).exists_for_patient()) |
-    #     (last_matching_event_apc_before(
+    #     ) |
+    #     has_matching_event_apc_before(
     #         stroke_isch_icd10, index_date
-    #     ).exists_for_patient())
+    #     )
     # )
 
     ## Project specific covariates-------------------------------------------------------------------------
 
     ### All stroke ('all stroke' will replace the core covariate 'ischaemic stroke' for this project)
     cov_bin_stroke_all = (
-        (last_matching_event_clinical_snomed_before(
-            stroke_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            stroke_icd10, index_date
-        ).exists_for_patient())
+        history_gp["stroke_all"].exists |
+        history_apc["stroke_all"].exists
     )
 
     ### Other arterial embolism 
     cov_bin_other_ae = (
-        (last_matching_event_clinical_snomed_before(
-            other_ae_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            other_ae_icd10, index_date
-        ).exists_for_patient())
+        history_gp["other_ae"].exists |
+        history_apc["other_ae"].exists
     )
 
     ### Venous thromboembolism events 
     cov_bin_vte = (
-        (last_matching_event_clinical_snomed_before(
-            vte_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            vte_icd10, index_date
-        ).exists_for_patient())
+        history_gp["vte"].exists |
+        history_apc["vte"].exists
     )
 
     ### Heart failure 
     cov_bin_hf = (
-        (last_matching_event_clinical_snomed_before(
-            hf_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            hf_icd10, index_date
-        ).exists_for_patient())
+        history_gp["hf"].exists |
+        history_apc["hf"].exists
     )
 
     ### Angina 
     cov_bin_angina = (
-        (last_matching_event_clinical_snomed_before(
-            angina_snomed, index_date
-        ).exists_for_patient()) |
-        (last_matching_event_apc_before(
-            angina_icd10, index_date
-        ).exists_for_patient())
+        history_gp["angina"].exists |
+        history_apc["angina"].exists
     )
 
     ### Lipid lowering medications
-    cov_bin_lipidmed = last_matching_med_dmd_before(
-        lipid_lowering_dmd, index_date
-    ).exists_for_patient()
+    cov_bin_lipidmed = history_med["lipidmed"].exists
 
     ### Antiplatelet medications 
-    cov_bin_antiplatelet = last_matching_med_dmd_before(
-        antiplatelet_dmd, index_date
-    ).exists_for_patient()
+    cov_bin_antiplatelet = history_med["antiplatelet"].exists
 
     ### Anticoagulation medications 
-    cov_bin_anticoagulant = last_matching_med_dmd_before(
-        anticoagulant_dmd, index_date
-    ).exists_for_patient()
+    cov_bin_anticoagulant = history_med["anticoagulant"].exists
 
     ### Combined oral contraceptive pill
-    cov_bin_cocp = last_matching_med_dmd_before(
-        cocp_dmd, index_date
-    ).exists_for_patient()
+    cov_bin_cocp = history_med["cocp"].exists
 
     ### Hormone replacement therapy
-    cov_bin_hrt = last_matching_med_dmd_before(
-        hrt_dmd, index_date
-    ).exists_for_patient()
+    cov_bin_hrt = history_med["hrt"].exists
 
     ## Subgroups-------------------------------------------------------------------------------------------
 
     ### History of COVID-19
-    tmp_sub_bin_covidhistory_sgss = (
-        sgss_covid_all_tests.where(
-            sgss_covid_all_tests.specimen_taken_date.is_before(index_date)
-        )
-        .where(sgss_covid_all_tests.is_positive)
-        .exists_for_patient()
-    )
-    tmp_sub_bin_covidhistory_gp = (
-        clinical_events.where(
-            (clinical_events.ctv3_code.is_in(
-                covid_primary_care_code + 
-                covid_primary_care_positive_test + 
-                covid_primary_care_sequalae)) &
-            clinical_events.date.is_before(index_date)
-        )
-        .exists_for_patient()
-    )
-    tmp_sub_bin_covidhistory_apc = (
-        apcs.where(
-            ((apcs.primary_diagnosis.is_in(covid_codes)) | (apcs.secondary_diagnosis.is_in(covid_codes))) & 
-            (apcs.admission_date.is_before(index_date))
-        )
-        .exists_for_patient()
-    )
-
-    sub_bin_covidhistory = (
-        tmp_sub_bin_covidhistory_sgss |
-        tmp_sub_bin_covidhistory_gp |
-        tmp_sub_bin_covidhistory_apc
-    )
+    sub_bin_covidhistory = covid.history
 
     ### COVID-19 severity
-    tmp_sub_date_covidhospital = (
-        apcs.where(
-            (apcs.primary_diagnosis.is_in(covid_codes)) & 
-            (apcs.admission_date.is_on_or_after(exp_date_covid))
-        )
-        .sort_by(apcs.admission_date)
-        .first_for_patient()
-        .admission_date
-    )
-
-    sub_cat_covidhospital = case(
-        when(
-            (exp_date_covid.is_not_null()) &
-            (tmp_sub_date_covidhospital.is_not_null()) &
-            ((tmp_sub_date_covidhospital - exp_date_covid).days >= 0) &
-            ((tmp_sub_date_covidhospital - exp_date_covid).days < 29)
-            ).then("hospitalised"),
-        when(exp_date_covid.is_not_null()).then("non_hospitalised"),
-        when(exp_date_covid.is_null()).then("no_infection")
-    )
+    sub_cat_covidhospital = covid.hospitalised
 
 
     ## Define dictionary of variables to be written into dataset-------------------------------------------
@@ -521,14 +454,7 @@ def generate_variables(index_date, end_date_exp, end_date_out):
         qa_num_birth_year = qa_num_birth_year,
         qa_bin_hrtcocp = qa_bin_hrtcocp,
         ### Outcomes (including tmp_* for Venn diagrams)
-        tmp_out_date_ami_gp = tmp_out_date_ami_gp,
-        tmp_out_date_ami_apc = tmp_out_date_ami_apc,
-        tmp_out_date_ami_death = tmp_out_date_ami_death,
-        out_date_ami = out_date_ami,
-        tmp_out_date_stroke_sahhs_gp = tmp_out_date_stroke_sahhs_gp,
-        tmp_out_date_stroke_sahhs_apc = tmp_out_date_stroke_sahhs_apc,
-        tmp_out_date_stroke_sahhs_death = tmp_out_date_stroke_sahhs_death,
-        out_date_stroke_sahhs = out_date_stroke_sahhs,
+        **outcome_variables,
         ### Strata
         strat_cat_region = strat_cat_region,
         ### Core covariates
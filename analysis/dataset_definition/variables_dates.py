@@ -8,21 +8,52 @@ from ehrql import (
 # Bring table definitions from the TPP backend 
 from ehrql.tables.tpp import ( 
     patients, 
-    vaccinations,
     ons_deaths,
 )
 
-# Codelists from codelists.py (which pulls all variables from the codelist folder)
-
-from codelists import *
+# Codelists from codelists.py (loaded on first access, so only the JCVI codelists are parsed)
+
+from codelists import (
+    preg_primis,
+    pregdel_primis,
+    shield_primis,
+    nonshield_primis,
+    ast_primis,
+    astadm_primis,
+    astrx_primis,
+    resp_primis,
+    cns_primis,
+    diab_primis,
+    dmres_primis,
+    sev_mental_primis,
+    smhres_primis,
+    chd_primis,
+    ckd15_primis,
+    ckd35_primis,
+    ckd_primis,
+    cld_primis,
+    immdx_primis,
+    immrx_primis,
+    spln_primis,
+    learndis_primis,
+    bmi_stage_primis,
+    bmi_primis,
+    sev_obesity_primis,
+    longres_primis,
+)
 
 from datetime import date
 
 # Call functions from variable_helper_functions
 from variable_helper_functions import (
-    last_matching_event_clinical_snomed_between,
+    last_matching_date_clinical_snomed_before,
+    last_matching_date_clinical_snomed_between,
     last_matching_event_clinical_snomed_before,
-    last_matching_med_dmd_between,
+    has_matching_event_clinical_snomed_before,
+    has_matching_event_clinical_snomed_between,
+    has_matching_med_dmd_between,
+    last_matching_events_clinical_snomed_before,
+    vaccination_dose_sequence,
 )
 
 # Define the study_dates dictionary 
@@ -56,14 +87,14 @@ vax_jcvi_age_2 = patients.age_on(ref_age_2)
 cov_cat_sex = patients.sex  # this is required for preg_group variables
 
     ## Date of last pregnancy code in 36 weeks before ref_cev
-preg_36wks_date = last_matching_event_clinical_snomed_between(
+preg_36wks_date = last_matching_date_clinical_snomed_between(
     preg_primis, ref_cev - days(252), ref_cev - days(1)
-).date
+)
 
     ## Date of last delivery code recorded in 36 weeks before elig_date
-pregdel_pre_date = last_matching_event_clinical_snomed_between(
+pregdel_pre_date = last_matching_date_clinical_snomed_between(
     pregdel_primis, ref_cev - days(252), ref_cev - days(1)
-).date
+)
 
 preg_group = (
     (preg_36wks_date.is_not_null()) & 
@@ -74,24 +105,47 @@ preg_group = (
     )
 )
 
+# History scans (one pass over clinical_events for the codelists sharing ref_ar)----------------------------
+
+    ## Codes recorded before ref_ar
+history_ar = last_matching_events_clinical_snomed_before(
+    dict(
+        ast = ast_primis,
+        astadm = astadm_primis,
+        resp = resp_primis,
+        cns = cns_primis,
+        diab = diab_primis,
+        dmres = dmres_primis,
+        sev_mental = sev_mental_primis,
+        smhres = smhres_primis,
+        chd = chd_primis,
+        ckd15 = ckd15_primis,
+        ckd35 = ckd35_primis,
+        ckd = ckd_primis,
+        cld = cld_primis,
+        immdx = immdx_primis,
+        spln = spln_primis,
+        learndis = learndis_primis,
+        bmi_stage = bmi_stage_primis,
+        bmi = bmi_primis,
+    ),
+    ref_ar
+)
+
 # cev_group (clinically extremely vulnerable group variables)--------------------------------
 
     ## Derived variables
 
     ## SHIELDED GROUP - first flag all patients with "high risk" codes
-severely_clinically_vulnerable = last_matching_event_clinical_snomed_before(
-    shield_primis, ref_cev
-).exists_for_patient()
+severely_clinically_vulnerable = has_matching_event_clinical_snomed_before(shield_primis, ref_cev)
 
     ## Find date at which the high risk code was added
-severely_clinically_vulnerable_date = last_matching_event_clinical_snomed_before(
-    shield_primis, ref_cev
-).date
+severely_clinically_vulnerable_date = last_matching_date_clinical_snomed_before(shield_primis, ref_cev)
 
     ## NOT SHIELDED GROUP (medium and low risk) - only flag if later than 'shielded'
-less_vulnerable = last_matching_event_clinical_snomed_between(
+less_vulnerable = has_matching_event_clinical_snomed_between(
     nonshield_primis, severely_clinically_vulnerable_date + days(1), ref_cev - days(1)
-).exists_for_patient()
+)
 
 cev_group = (
     severely_clinically_vulnerable & (less_vulnerable == False)
@@ -102,55 +156,43 @@ cev_group = (
 # asthma_group
     ## Derived variables for asthma_group
     ## Asthma Diagnosis codes
-astdx = last_matching_event_clinical_snomed_before(
-    ast_primis, ref_ar
-).exists_for_patient()
+astdx = history_ar["ast"].exists
 
     ## Asthma Admission codes
-astadm = last_matching_event_clinical_snomed_before(
-    astadm_primis, ref_ar
-).exists_for_patient()
+astadm = history_ar["astadm"].exists
 
     ## Asthma systemic steroid prescription code in month 1
-astrxm1 = last_matching_med_dmd_between(
+astrxm1 = has_matching_med_dmd_between(
     astrx_primis, ref_ar - days(31), ref_ar - days(1)
-).exists_for_patient()
+)
 
     ## Asthma systemic steroid prescription code in month 2
-astrxm2 = last_matching_med_dmd_between(
+astrxm2 = has_matching_med_dmd_between(
     astrx_primis, ref_ar - days(61), ref_ar - days(32)
-).exists_for_patient()
+)
 
     ## Asthma systemic steroid prescription code in month 3
-astrxm3 = last_matching_med_dmd_between(
+astrxm3 = has_matching_med_dmd_between(
     astrx_primis, ref_ar - days(91), ref_ar - days(62)
-).exists_for_patient()
+)
 
 asthma_group = (
     (astadm) | (astdx & astrxm1 & astrxm2 & astrxm3)
 )
 
 # resp_group (Chronic Respiratory Disease other than asthma)
-resp_group = last_matching_event_clinical_snomed_before(
-    resp_primis, ref_ar
-).exists_for_patient()
+resp_group = history_ar["resp"].exists
 
 # cns_group (Chronic Neurological Disease including Significant Learning Disorder)
-cns_group = last_matching_event_clinical_snomed_before(
-    cns_primis, ref_ar
-).exists_for_patient()
+cns_group = history_ar["cns"].exists
 
 # diab_group (Diabetes)
     ## Derived variables for diab_group (Diabetes)
     ## Diabetes diagnosis codes
-diab_date = last_matching_event_clinical_snomed_before(
-    diab_primis, ref_ar
-).date
+diab_date = history_ar["diab"].date
 
     ## Diabetes resolved codes
-dmres_date = last_matching_event_clinical_snomed_before(
-    dmres_primis, ref_ar
-).date
+dmres_date = history_ar["dmres"].date
 
 diab_group = (
     (dmres_date.is_null() & diab_date.is_not_null()) | (dmres_date < diab_date)
@@ -159,40 +201,28 @@ diab_group = (
 # sevment_group (severe mental illness codes)
     ## Derived variables for sevment_group (severe mental illness codes)
     ## Severe Mental Illness codes
-sev_mental_date = last_matching_event_clinical_snomed_before(
-    sev_mental_primis, ref_ar
-).date
+sev_mental_date = history_ar["sev_mental"].date
 
     ## Remission codes relating to Severe Mental Illness
-smhres_date = last_matching_event_clinical_snomed_before(
-    smhres_primis, ref_ar
-).date
+smhres_date = history_ar["smhres"].date
 
 sevment_group = (
     (smhres_date.is_null() & sev_mental_date.is_not_null()) | (smhres_date < sev_mental_date)
 )
 
 # chd_group (Chronic heart disease codes)
-chd_group = last_matching_event_clinical_snomed_before(
-    chd_primis, ref_ar
-).exists_for_patient()
+chd_group = history_ar["chd"].exists
 
 # ckd_group (Chronic kidney disease diagnostic codes)
     ## Derived variables for ckd_group (Chronic kidney disease diagnostic codes)
     ## Chronic kidney disease codes - all stages
-ckd15_date = last_matching_event_clinical_snomed_before(
-    ckd15_primis, ref_ar
-).date
+ckd15_date = history_ar["ckd15"].date
 
     ## Chronic kidney disease codes-stages 3 - 5
-ckd35_date = last_matching_event_clinical_snomed_before(
-    ckd35_primis, ref_ar
-).date
+ckd35_date = history_ar["ckd35"].date
 
     ## Chronic kidney disease diagnostic codes
-ckd = last_matching_event_clinical_snomed_before(
-    ckd_primis, ref_ar
-).exists_for_patient()
+ckd = history_ar["ckd"].exists
 
 ckd_group = (
     ckd | 
@@ -201,51 +231,39 @@ ckd_group = (
 )
 
 # cld_group (Chronic Liver disease codes)
-cld_group = last_matching_event_clinical_snomed_before(
-    cld_primis, ref_ar
-).exists_for_patient()
+cld_group = history_ar["cld"].exists
 
 # immuno_group (immunosuppressed)
     ## Derived variables for immuno_group (immunosuppressed)
     ## Immunosuppression diagnosis codes
-immdx = last_matching_event_clinical_snomed_before(
-    immdx_primis, ref_ar
-).exists_for_patient()
+immdx = history_ar["immdx"].exists
 
     ## Immunosuppression medication codes
-immrx = last_matching_med_dmd_between(
+immrx = has_matching_med_dmd_between(
     immrx_primis, ref_ar - days(180), ref_ar - days(1)
-).exists_for_patient()
+)
 
 immuno_group = (immdx | immrx)
 
 
 # spln_group (Asplenia or Dysfunction of the Spleen codes)
-spln_group = last_matching_event_clinical_snomed_before(
-    spln_primis, ref_ar
-).exists_for_patient()
+spln_group = history_ar["spln"].exists
 
 # learndis_group (Wider Learning Disability)
-learndis_group = last_matching_event_clinical_snomed_before(
-    learndis_primis, ref_ar
-).exists_for_patient()
+learndis_group = history_ar["learndis"].exists
 
 # sevobese_group (Severe obesity)
     ## Derived variables for sevobese_group (Severe obesity)
     ## All BMI coded terms
-bmi_stage_date = last_matching_event_clinical_snomed_before(
-    bmi_stage_primis, ref_ar
-).date
+bmi_stage_date = history_ar["bmi_stage"].date
 
     ## Severe Obesity code recorded
-sev_obesity_date = last_matching_event_clinical_snomed_between(
+sev_obesity_date = last_matching_date_clinical_snomed_between(
     sev_obesity_primis, bmi_stage_date, ref_ar - days(1)
-).date
+)
 
     ## BMI_primis
-bmi_date = last_matching_event_clinical_snomed_before(
-    bmi_primis, ref_ar
-).date
+bmi_date = history_ar["bmi"].date
 
     ## BMI value
 bmi_value_temp = last_matching_event_clinical_snomed_before(
@@ -275,9 +293,7 @@ atrisk_group = (
 )
 
 # longres_group (Patients in long-stay nursing and residential care)----------------------------
-longres_group = last_matching_event_clinical_snomed_before(
-    longres_primis, vax1_earliest
-).exists_for_patient()
+longres_group = has_matching_event_clinical_snomed_before(longres_primis, vax1_earliest)
 
 # jcvi_group
 vax_cat_jcvi_group = case(
@@ -365,148 +381,32 @@ death_date = minimum_of(primary_care_death_date, ons_died_from_any_cause_date)
 
 # add vaccination dates----------------------------------------------------------------------------
 
-# COVID-19 Vaccination (identified by target diseases of the vaccination)
-
-vax_date_covid_1 = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
-)
-
-vax_date_covid_2 = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .where(vaccinations.date > vax_date_covid_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
-)
-
-vax_date_covid_3 = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .where(vaccinations.date > vax_date_covid_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
-
-vax_num_covid = (
-    vaccinations.where(
-    vaccinations.target_disease.contains("SARS-2 CORONAVIRUS"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
+# COVID-19 Vaccination (identified by target diseases of the vaccination), plus one sequence per product
+# (identified by vaccination_id.product_name) under a compact product id:
+    ## Pfizer: 28.COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)
+    ## AstraZeneca: 49.COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)
+    ## Moderna: 30.COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)
+vax_products = dict(
+    Pfizer = "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
+    AstraZeneca = "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)",
+    Moderna = "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
 )
 
-# Pfizer BioNTech Vaccination (identified by vaccination_id.product_name: 28.COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer))
-vax_date_Pfizer_1 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
+vax_sequence = vaccination_dose_sequence(
+    "SARS-2 CORONAVIRUS", vax_products, vax1_earliest, n_doses=3
 )
 
-vax_date_Pfizer_2 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .where(vaccinations.date > vax_date_Pfizer_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
-)
-
-vax_date_Pfizer_3 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .where(vaccinations.date > vax_date_Pfizer_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
-
-vax_num_Pfizer = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
-)
-
-# Oxford AZ Vaccination (identified by vaccination_id.product_name: 49.COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca))
-
-vax_date_AstraZeneca_1 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
-)
-
-vax_date_AstraZeneca_2 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .where(vaccinations.date > vax_date_AstraZeneca_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
-)
+vax_date_covid_1, vax_date_covid_2, vax_date_covid_3 = vax_sequence["covid"].dates
+vax_num_covid = vax_sequence["covid"].count
 
-vax_date_AstraZeneca_3 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .where(vaccinations.date > vax_date_AstraZeneca_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
-
-vax_num_AstraZeneca = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
-)
-
-# Moderna Vaccination (identified by vaccination_id.product_name: 30.COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna))
-
-vax_date_Moderna_1 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .where(vaccinations.date.is_on_or_after(vax1_earliest))
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date
-)
+vax_date_Pfizer_1, vax_date_Pfizer_2, vax_date_Pfizer_3 = vax_sequence["Pfizer"].dates
+vax_num_Pfizer = vax_sequence["Pfizer"].count
 
-vax_date_Moderna_2 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .where(vaccinations.date > vax_date_Moderna_1)  # Exclude the first date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the second date
-)
+vax_date_AstraZeneca_1, vax_date_AstraZeneca_2, vax_date_AstraZeneca_3 = vax_sequence["AstraZeneca"].dates
+vax_num_AstraZeneca = vax_sequence["AstraZeneca"].count
 
-vax_date_Moderna_3 = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .where(vaccinations.date > vax_date_Moderna_2)  # Exclude the first and second date
-    .sort_by(vaccinations.date)
-    .first_for_patient()
-    .date  # Now this will be the third date
-)
-
-vax_num_Moderna = (
-    vaccinations.where(
-    (vaccinations.product_name == "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"))
-    .sort_by(vaccinations.date)
-    .count_for_patient()
-)
+vax_date_Moderna_1, vax_date_Moderna_2, vax_date_Moderna_3 = vax_sequence["Moderna"].dates
+vax_num_Moderna = vax_sequence["Moderna"].count
 
 # Define a dictionary of preliminary date variables (Death, Vaccination) created above 
 prelim_date_variables = dict(
@@ -0,0 +1,173 @@
+# ------------------------------------------------------------------------------
+#
+# dummy_dataset_cache.py
+#
+# This file runs ehrql generate-dataset on dummy data through a content-
+# addressed cache, so that local and CI re-runs of generate_dates and
+# generate_input_prevax are near-instant when nothing they depend on has
+# changed
+#
+# Usage (from the repository root, in an environment with ehrQL v1 installed;
+# see require_ehrql in utility.py):
+#   python analysis/dummy_data/dummy_dataset_cache.py \
+#     analysis/dataset_definition/dataset_definition_dates.py \
+#     --output output/dataset_definition/index_dates.arrow \
+#     [--dummy-tables DIR] [--cache-dir DIR] [--max-bytes N] [-- USER_ARGS]
+#
+# Arguments:
+#  - definition - path to the dataset definition
+#  - --output - dataset output path, as for ehrql generate-dataset
+#  - --dummy-tables - optional directory of dummy tables; without it ehrQL's
+#                     dummy tables are generated (create-dummy-tables) and
+#                     cached alongside the output
+#  - --cache-dir - cache location (default output/.dummy_dataset_cache, or
+#                  DUMMY_DATASET_CACHE_DIR)
+#  - --max-bytes - cache size limit; least recently used entries are evicted
+#                  beyond it (default 2GB, or DUMMY_DATASET_CACHE_MAX_BYTES)
+#  - USER_ARGS - arguments passed through to the dataset definition
+#
+# Returns:
+#  - The dataset at --output, copied from the cache when an entry exists for
+#    the same key: a hash of the definition's query graph, study_dates.json,
+#    the codelist files, the dummy tables (if given), the output format, the
+#    dummy population size and the ehrQL version
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utility import load_dataset, ehrql_version, file_digest, output_suffix, tree_digest, variable_fingerprints
+
+default_cache_dir = os.environ.get("DUMMY_DATASET_CACHE_DIR", "output/.dummy_dataset_cache")
+default_max_bytes = int(os.environ.get("DUMMY_DATASET_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+study_dates_file = "output/study_dates.json"
+codelist_dir = "codelists"
+
+
+# Cache key --------------------------------------------------------------------
+
+def graph_digest(definition, user_args):
+    fingerprints = variable_fingerprints(load_dataset(definition, user_args))
+    sha = hashlib.sha256()
+    for name, fingerprint in sorted(fingerprints.items()):
+        sha.update(f"{name}={fingerprint}\n".encode())
+    return sha.hexdigest()
+
+def cache_key(definition, output, dummy_tables, user_args):
+    parts = dict(
+        graph=graph_digest(definition, user_args),
+        study_dates=file_digest(study_dates_file) if os.path.exists(study_dates_file) else "",
+        codelists=tree_digest(codelist_dir, suffixes=(".csv",)),
+        dummy_tables=tree_digest(dummy_tables) if dummy_tables else "",
+        output_format=output_suffix(output),
+        population_size=os.environ.get("DUMMY_POPULATION_SIZE", ""),
+        # dummy data and outputs can change between ehrQL releases
+        ehrql=ehrql_version(),
+    )
+    sha = hashlib.sha256()
+    for name, digest in sorted(parts.items()):
+        sha.update(f"{name}={digest}\n".encode())
+    return sha.hexdigest()
+
+
+# Cache entries ----------------------------------------------------------------
+# Each entry is a directory named by its key holding the output (and the dummy
+# tables it was generated from); its mtime records when it was last used
+
+def entry_size(entry):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(entry) for name in names
+    )
+
+def evict(cache_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if os.path.isdir(entry) and not name.endswith(".tmp"):
+            entries.append((os.path.getmtime(entry), entry, entry_size(entry)))
+    total = sum(size for _, _, size in entries)
+    for _, entry, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry != keep:
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+    return total
+
+def generate(definition, output, dummy_tables, user_args, entry):
+    ehrql = [sys.executable, "-m", "ehrql"]
+    user_args = ["--", *user_args] if user_args else []
+    tmp_entry = f"{entry}.{os.getpid()}.tmp"
+    os.makedirs(tmp_entry)
+    try:
+        if dummy_tables is None:
+            dummy_tables = os.path.join(tmp_entry, "tables")
+            subprocess.run(ehrql + ["create-dummy-tables", definition, dummy_tables, *user_args], check=True)
+        subprocess.run(
+            ehrql + [
+                "generate-dataset", definition,
+                "--dummy-tables", dummy_tables,
+                "--output", os.path.join(tmp_entry, "dataset" + output_suffix(output)),
+                *user_args,
+            ],
+            check=True,
+        )
+        os.replace(tmp_entry, entry)
+    except BaseException:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        raise
+
+
+def run(definition, output, dummy_tables=None, user_args=(), cache_dir=default_cache_dir, max_bytes=default_max_bytes):
+    start = time.perf_counter()
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(definition, output, dummy_tables, user_args)
+    entry = os.path.join(cache_dir, key)
+    hit = os.path.isdir(entry)
+    if hit:
+        os.utime(entry)
+    else:
+        generate(definition, output, dummy_tables, user_args, entry)
+        evict(cache_dir, max_bytes, keep=entry)
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    shutil.copyfile(os.path.join(entry, "dataset" + output_suffix(output)), output)
+    print(
+        f"dummy dataset cache {'hit' if hit else 'miss'} ({key[:12]}): "
+        f"{output} in {time.perf_counter() - start:.1f}s",
+        file=sys.stderr
+    )
+    return hit
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    user_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, user_args = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description="Generate a dummy dataset through a content-addressed cache")
+    parser.add_argument("definition")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--dummy-tables", default=None)
+    parser.add_argument("--cache-dir", default=default_cache_dir)
+    parser.add_argument("--max-bytes", type=int, default=default_max_bytes)
+    args = parser.parse_args(argv)
+
+    run(args.definition, args.output, args.dummy_tables, user_args, args.cache_dir, args.max_bytes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+# ------------------------------------------------------------------------------
+#
+# generate_dummy_tables.py
+#
+# This file generates large synthetic TPP-shaped tables for local runs and
+# benchmarks, much faster than ehrQL's own dummy data generator. Codes are
+# drawn from the codelists defined in codelists.py, so that the codelist
+# filters in the dataset definitions (e.g. apcs.all_diagnoses.contains_any_of)
+# are exercised
+#
+# Usage (from the repository root; needs numpy and pyarrow, and uses ehrql's
+# table schemas when ehrql is installed, see "Schemas" below):
+#   python analysis/dummy_data/generate_dummy_tables.py OUTPUT_DIR \
+#     [--population-size 1000000] [--prevalence 0.2] [--rate clinical_events=30] \
+#     [--start-date 2016-01-01] [--end-date 2024-12-31] [--seed 1] [--format arrow]
+#
+# Arguments:
+#  - OUTPUT_DIR - directory to write one file per table into; pass it to
+#                 ehrql generate-dataset --dummy-tables
+#  - --population-size - number of patients
+#  - --prevalence - share of coded events drawn from the study codelists (the
+#                   rest use codes that match no codelist)
+#  - --rate - mean rows per patient for an event table (repeatable)
+#  - --start-date, --end-date - range for event dates
+#  - --chunk-size - patients generated per batch (bounds memory use)
+#  - --format - arrow (default) or csv
+#  - --empty-table - a table the generator does not model, written with no rows
+#                    so that a definition reading it can run (repeatable)
+#
+# Returns:
+#  - patients, practice_registrations, addresses, clinical_events,
+#    medications, apcs, vaccinations, ons_deaths, sgss_covid_all_tests and
+#    emergency_care_attendances tables (and any --empty-table) in OUTPUT_DIR
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dataset_definition"))
+
+from utility import codelist_codes
+
+# Defaults ---------------------------------------------------------------------
+
+# Tables the generator models; any other table a definition reads can be
+# written empty with --empty-table
+generated_tables = (
+    "patients", "practice_registrations", "addresses", "clinical_events", "medications", "apcs",
+    "vaccinations", "ons_deaths", "sgss_covid_all_tests", "emergency_care_attendances",
+)
+
+default_rates = dict(
+    clinical_events=20.0,
+    medications=15.0,
+    apcs=0.8,
+    vaccinations=2.5,
+    sgss_covid_all_tests=1.0,
+    emergency_care_attendances=0.5,
+)
+
+vaccine_products = [
+    "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
+    "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)",
+    "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
+]
+
+regions = np.array([
+    "North East", "North West", "Yorkshire and The Humber", "East Midlands", "West Midlands",
+    "East", "London", "South East", "South West",
+])
+
+# Codelists --------------------------------------------------------------------
+# Codes from every codelist in codelists.py, grouped by coding system
+
+def load_code_pools(rng, noise_size=10000):
+    codes = dict(snomed=set(), ctv3=set(), dmd=set(), icd10=set())
+    for systems in codelist_codes().values():
+        for system, system_codes in systems.items():
+            codes[system].update(system_codes)
+    # each pool holds the codelist codes followed by noise codes; codes are drawn by index
+    pools = {}
+    for system, system_codes in codes.items():
+        pool_codes = sorted(system_codes)
+        pools[system] = (
+            pa.array(pool_codes + noise_codes(rng, system, noise_size, system_codes), type=pa.string()),
+            len(pool_codes),
+        )
+    return pools
+
+def noise_candidates(rng, system, size):
+    # codes in the right shape for the coding system
+    if system == "icd10":
+        return np.char.add(rng.choice(list("VWXY"), size), rng.integers(100, 1000, size).astype(str))
+    if system == "ctv3":
+        return np.char.add("Zz", rng.integers(100, 999, size).astype(str))
+    return rng.integers(10**15, 10**16, size).astype(str)
+
+def matches_codelist(code, system, codelist_codes):
+    # ICD-10 codes are matched within apcs.all_diagnoses by contains_any_of, so a noise code must not
+    # contain any codelist code; other systems are matched on the whole code
+    if system == "icd10":
+        return any(codelist_code in code for codelist_code in codelist_codes)
+    return code in codelist_codes
+
+def noise_codes(rng, system, size, codelist_codes, attempts=10):
+    # codes that match no study codelist, so --prevalence is the share of codelist matches
+    noise = []
+    for _ in range(attempts):
+        candidates = set(noise_candidates(rng, system, size).tolist()).difference(noise)
+        noise.extend(sorted(code for code in candidates if not matches_codelist(code, system, codelist_codes)))
+        if len(noise) >= size:
+            return noise[:size]
+    if not noise:
+        raise ValueError(f"could not generate {system} noise codes that match no codelist")
+    return noise
+
+def draw_codes(rng, pools, system, size, prevalence, mask=None):
+    pool, codelist_size = pools[system]
+    noise_size = len(pool) - codelist_size
+    from_codelist = (rng.random(size) < prevalence) & (codelist_size > 0)
+    index = np.where(
+        from_codelist,
+        rng.integers(0, max(codelist_size, 1), size),
+        codelist_size + rng.integers(0, noise_size, size),
+    )
+    return pool.take(pa.array(index, mask=mask))
+
+
+# Dates ------------------------------------------------------------------------
+
+def to_days(value):
+    return (value - datetime.date(1970, 1, 1)).days
+
+def uniform_dates(rng, start, end, size):
+    return rng.integers(to_days(start), to_days(end) + 1, size)
+
+def date_array(days, mask=None):
+    return pa.array(np.asarray(days, dtype="int32"), type=pa.int32(), mask=mask).cast(pa.date32())
+
+
+# Tables -----------------------------------------------------------------------
+# Each function returns {column: pyarrow array} for one chunk of patients
+
+def events_per_patient(rng, patient_ids, rate):
+    counts = rng.poisson(rate, len(patient_ids))
+    return np.repeat(patient_ids, counts)
+
+def patients_table(rng, ids, config):
+    size = len(ids)
+    birth = uniform_dates(rng, datetime.date(1920, 1, 1), datetime.date(2005, 12, 31), size)
+    # dates of birth are recorded as the first of the month
+    birth = birth.astype("datetime64[D]").astype("datetime64[M]").astype("datetime64[D]").astype("int64")
+    died = rng.random(size) < 0.05
+    death = uniform_dates(rng, datetime.date(2019, 1, 1), config.end_date, size)
+    return dict(
+        patient_id=pa.array(ids),
+        date_of_birth=date_array(birth),
+        sex=pa.array(rng.choice(np.array(["female", "male"]), size)),
+        date_of_death=date_array(death, mask=~died),
+    ), died, death
+
+def practice_registrations_table(rng, ids, config):
+    size = len(ids)
+    start = uniform_dates(rng, datetime.date(1990, 1, 1), datetime.date(2019, 1, 1), size)
+    left = rng.random(size) < 0.1
+    end = uniform_dates(rng, datetime.date(2019, 1, 2), config.end_date, size)
+    return dict(
+        patient_id=pa.array(ids),
+        start_date=date_array(start),
+        end_date=date_array(end, mask=~left),
+        practice_pseudo_id=pa.array(rng.integers(1, 2000, size)),
+        practice_nuts1_region_name=pa.array(rng.choice(regions, size)),
+    )
+
+def addresses_table(rng, ids, config):
+    size = len(ids)
+    care_home = rng.random(size) < 0.02
+    return dict(
+        patient_id=pa.array(ids),
+        address_id=pa.array(ids),
+        start_date=date_array(uniform_dates(rng, datetime.date(1990, 1, 1), datetime.date(2019, 1, 1), size)),
+        end_date=date_array(np.zeros(size), mask=np.ones(size, dtype=bool)),
+        imd_rounded=pa.array(rng.integers(0, 329, size) * 100),
+        care_home_is_potential_match=pa.array(care_home),
+        care_home_requires_nursing=pa.array(care_home & (rng.random(size) < 0.5)),
+        care_home_does_not_require_nursing=pa.array(care_home & (rng.random(size) < 0.5)),
+    )
+
+def clinical_events_table(rng, ids, config, pools):
+    patient_id = events_per_patient(rng, ids, config.rates["clinical_events"])
+    size = len(patient_id)
+    ctv3 = rng.random(size) < 0.1
+    return dict(
+        patient_id=pa.array(patient_id),
+        date=date_array(uniform_dates(rng, config.start_date, config.end_date, size)),
+        snomedct_code=draw_codes(rng, pools, "snomed", size, config.prevalence, mask=ctv3),
+        ctv3_code=draw_codes(rng, pools, "ctv3", size, config.prevalence, mask=~ctv3),
+        numeric_value=pa.array(rng.normal(28, 6, size).round(1)),
+    )
+
+def medications_table(rng, ids, config, pools):
+    patient_id = events_per_patient(rng, ids, config.rates["medications"])
+    size = len(patient_id)
+    return dict(
+        patient_id=pa.array(patient_id),
+        date=date_array(uniform_dates(rng, config.start_date, config.end_date, size)),
+        dmd_code=draw_codes(rng, pools, "dmd", size, config.prevalence),
+    )
+
+def apcs_table(rng, ids, config, pools):
+    patient_id = events_per_patient(rng, ids, config.rates["apcs"])
+    size = len(patient_id)
+    admission = uniform_dates(rng, config.start_date, config.end_date, size)
+    primary = draw_codes(rng, pools, "icd10", size, config.prevalence)
+    secondary = draw_codes(rng, pools, "icd10", size, config.prevalence)
+    other = draw_codes(rng, pools, "icd10", size, config.prevalence)
+    # all_diagnoses lists every diagnosis code of the spell, as in TPP's APCS data
+    all_diagnoses = pc.binary_join_element_wise("", primary, " ||", secondary, " ||", other, " ||", "")
+    all_diagnoses = pc.binary_join_element_wise("||", all_diagnoses, "")
+    return dict(
+        patient_id=pa.array(patient_id),
+        apcs_ident=pa.array(np.arange(size) + int(ids[0]) * 100),
+        admission_date=date_array(admission),
+        discharge_date=date_array(admission + rng.integers(0, 30, size)),
+        primary_diagnosis=primary,
+        secondary_diagnosis=secondary,
+        all_diagnoses=all_diagnoses,
+    )
+
+def vaccinations_table(rng, ids, config):
+    doses = np.minimum(rng.poisson(config.rates["vaccinations"], len(ids)), 5)
+    patient_id = np.repeat(ids, doses)
+    size = len(patient_id)
+    # dose k is given 8-12 weeks after dose k - 1
+    dose_number = np.arange(size) - np.repeat(np.cumsum(doses) - doses, doses)
+    first = np.repeat(uniform_dates(rng, datetime.date(2020, 12, 8), datetime.date(2021, 6, 30), len(ids)), doses)
+    date = first + dose_number * rng.integers(56, 85, size)
+    products = pa.array(vaccine_products)
+    return dict(
+        patient_id=pa.array(patient_id),
+        vaccination_id=pa.array(np.arange(size) + int(ids[0]) * 10),
+        date=date_array(date),
+        target_disease=pa.array(["SARS-2 CORONAVIRUS"]).take(pa.array(np.zeros(size, dtype="int64"))),
+        product_name=products.take(pa.array(np.repeat(rng.integers(0, len(vaccine_products), len(ids)), doses))),
+    )
+
+def ons_deaths_table(rng, ids, config, pools, died, death):
+    patient_id, death = ids[died], death[died]
+    size = len(patient_id)
+    columns = dict(
+        patient_id=pa.array(patient_id),
+        date=date_array(death),
+        underlying_cause_of_death=draw_codes(rng, pools, "icd10", size, config.prevalence),
+    )
+    for position in range(1, 16):
+        missing = rng.random(size) < min(0.3 + position * 0.05, 0.95)
+        columns[f"cause_of_death_{position:02d}"] = draw_codes(
+            rng, pools, "icd10", size, config.prevalence, mask=missing
+        )
+    return columns
+
+def sgss_covid_all_tests_table(rng, ids, config):
+    patient_id = events_per_patient(rng, ids, config.rates["sgss_covid_all_tests"])
+    size = len(patient_id)
+    return dict(
+        patient_id=pa.array(patient_id),
+        specimen_taken_date=date_array(uniform_dates(rng, datetime.date(2020, 3, 1), datetime.date(2022, 12, 31), size)),
+        is_positive=pa.array(rng.random(size) < 0.3),
+    )
+
+def emergency_care_attendances_table(rng, ids, config, pools):
+    patient_id = events_per_patient(rng, ids, config.rates["emergency_care_attendances"])
+    size = len(patient_id)
+    columns = dict(
+        patient_id=pa.array(patient_id),
+        id=pa.array(np.arange(size) + int(ids[0]) * 10),
+        arrival_date=date_array(uniform_dates(rng, config.start_date, config.end_date, size)),
+    )
+    for position in range(1, 25):
+        missing = rng.random(size) < min(0.2 * position, 0.99)
+        columns[f"diagnosis_{position:02d}"] = draw_codes(
+            rng, pools, "snomed", size, config.prevalence, mask=missing
+        )
+    return columns
+
+
+# Schemas ----------------------------------------------------------------------
+# Columns follow ehrQL's TPP table schemas where ehrql is installed; columns the
+# generator does not model are written as nulls of the declared type
+
+arrow_types = {"date": pa.date32(), "bool": pa.bool_(), "int": pa.int64(), "float": pa.float64()}
+
+def ehrql_schema(table_name):
+    try:
+        from ehrql.tables import tpp
+    except ImportError:
+        return None
+    schema = getattr(getattr(tpp, table_name), "_qm_node").schema
+    return [(name, schema.get_column_type(name)) for name in schema.column_names]
+
+def arrow_type(column_type):
+    name = getattr(column_type, "__name__", str(column_type))
+    return arrow_types.get(name, pa.string())
+
+def conform(table_name, columns):
+    size = len(columns["patient_id"])
+    schema = ehrql_schema(table_name)
+    if schema is None:
+        return pa.table(columns)
+    conformed = dict(patient_id=columns["patient_id"])
+    for name, column_type in schema:
+        if name in columns:
+            conformed[name] = columns[name].cast(arrow_type(column_type))
+        else:
+            conformed[name] = pa.nulls(size, type=arrow_type(column_type))
+    return pa.table(conformed)
+
+
+# Writers ----------------------------------------------------------------------
+
+class TableWriters:
+    def __init__(self, directory, file_format):
+        self.directory = directory
+        self.file_format = file_format
+        self.writers = {}
+        self.rows = {}
+
+    def write(self, table_name, table):
+        if table_name not in self.writers:
+            path = os.path.join(self.directory, f"{table_name}.{self.file_format}")
+            if self.file_format == "arrow":
+                self.writers[table_name] = pa.ipc.new_file(path, table.schema)
+            else:
+                self.writers[table_name] = pa_csv.CSVWriter(path, table.schema)
+            self.rows[table_name] = 0
+        self.writers[table_name].write_table(table)
+        self.rows[table_name] += table.num_rows
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+# Generate ---------------------------------------------------------------------
+
+def generate(directory, population_size, config, chunk_size=500000, file_format="arrow", seed=1, empty_tables=()):
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    pools = load_code_pools(rng)
+    writers = TableWriters(directory, file_format)
+    start = time.perf_counter()
+    try:
+        for first in range(1, population_size + 1, chunk_size):
+            ids = np.arange(first, min(first + chunk_size, population_size + 1), dtype="int64")
+            patients, died, death = patients_table(rng, ids, config)
+            tables = dict(
+                patients=patients,
+                practice_registrations=practice_registrations_table(rng, ids, config),
+                addresses=addresses_table(rng, ids, config),
+                clinical_events=clinical_events_table(rng, ids, config, pools),
+                medications=medications_table(rng, ids, config, pools),
+                apcs=apcs_table(rng, ids, config, pools),
+                vaccinations=vaccinations_table(rng, ids, config),
+                ons_deaths=ons_deaths_table(rng, ids, config, pools, died, death),
+                sgss_covid_all_tests=sgss_covid_all_tests_table(rng, ids, config),
+                emergency_care_attendances=emergency_care_attendances_table(rng, ids, config, pools),
+            )
+            for table_name, columns in tables.items():
+                writers.write(table_name, conform(table_name, columns))
+        for table_name in empty_tables:
+            if table_name not in generated_tables:
+                writers.write(table_name, conform(table_name, dict(patient_id=pa.array([], type=pa.int64()))))
+    finally:
+        writers.close()
+    seconds = time.perf_counter() - start
+    total = sum(writers.rows.values())
+    print(f"{total} rows for {population_size} patients in {seconds:.1f}s ({total / seconds:,.0f} rows/s)")
+    return writers.rows
+
+
+class Config:
+    def __init__(self, prevalence, rates, start_date, end_date):
+        self.prevalence = prevalence
+        self.rates = rates
+        self.start_date = start_date
+        self.end_date = end_date
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic TPP-shaped dummy tables")
+    parser.add_argument("output_dir")
+    parser.add_argument("--population-size", type=int, default=10000)
+    parser.add_argument("--prevalence", type=float, default=0.2)
+    parser.add_argument("--rate", action="append", default=[], metavar="TABLE=RATE")
+    parser.add_argument("--start-date", type=datetime.date.fromisoformat, default=datetime.date(2016, 1, 1))
+    parser.add_argument("--end-date", type=datetime.date.fromisoformat, default=datetime.date(2024, 12, 31))
+    parser.add_argument("--chunk-size", type=int, default=500000)
+    parser.add_argument("--format", choices=["arrow", "csv"], default="arrow")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--empty-table", action="append", default=[], metavar="TABLE")
+    args = parser.parse_args(argv)
+
+    rates = dict(default_rates)
+    for rate in args.rate:
+        table_name, value = rate.split("=")
+        if table_name not in rates:
+            parser.error(f"unknown event table {table_name!r}")
+        rates[table_name] = float(value)
+
+    config = Config(args.prevalence, rates, args.start_date, args.end_date)
+    generate(args.output_dir, args.population_size, config, args.chunk_size, args.format, args.seed, args.empty_table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# ------------------------------------------------------------------------------
+#
+# incremental_extract.py
+#
+# This file re-runs ehrql generate-dataset for only the variables whose
+# definition changed since the previous run, and patches them into the
+# previous output by patient_id, so that iterating on one covariate or
+# codelist does not cost a full extraction
+#
+# Usage (from the repository root, in an environment with ehrQL v1 installed;
+# see require_ehrql in utility.py):
+#   python analysis/incremental_extract/incremental_extract.py \
+#     analysis/dataset_definition/dataset_definition_prevax.py \
+#     --output output/dataset_definition/input_prevax.arrow \
+#     --dummy-tables DIR [--full] [-- USER_ARGS]
+#
+# Arguments:
+#  - definition - path to the dataset definition
+#  - --output - dataset output path (.arrow, .csv or .csv.gz), as for ehrql
+#               generate-dataset; the previous output at this path is patched
+#  - --dummy-tables - directory of tables to extract from; patches are only
+#                     exact against a fixed set of tables, so without it every
+#                     run is a full extraction
+#  - --full - ignore the previous output and extract everything
+#  - USER_ARGS - arguments passed through to the dataset definition
+#
+# Returns:
+#  - The dataset at --output
+#  - OUTPUT.fingerprints.json - the fingerprint of each variable (its query
+#    graph, including codelist codes and study dates, and any
+#    @table_from_file input) and of the population, used by the next run
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+analysis_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, analysis_dir)
+
+from utility import (
+    load_dataset, output_suffix, read_output, tree_digest, variable_fingerprints, write_output,
+)
+
+
+# Fingerprint state ------------------------------------------------------------
+
+def state_path(output):
+    return output + ".fingerprints.json"
+
+def load_state(output):
+    if not os.path.exists(output):
+        return None
+    try:
+        with open(state_path(output)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_state(output, state):
+    with open(state_path(output), "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+def changed_variables(previous, current):
+    # None when the previous output cannot be patched (population, tables or
+    # user arguments changed); otherwise the variables to re-extract
+    if previous is None:
+        return None
+    for key in ("dummy_tables", "user_args"):
+        if previous.get(key) != current[key]:
+            return None
+    old, new = previous["fingerprints"], current["fingerprints"]
+    if old.get("population") != new["population"]:
+        return None
+    return [name for name in new if name != "population" and old.get(name) != new[name]]
+
+
+# Patch outputs ----------------------------------------------------------------
+
+def patch(previous, update, names, order):
+    # replace (or add) the updated columns, matching rows on patient_id, and
+    # keep the dataset's column order
+    kept = previous.drop_columns([
+        name for name in previous.column_names
+        if name != "patient_id" and (name in names or name not in order)
+    ])
+    if update.column("patient_id").type != kept.column("patient_id").type:
+        update = update.set_column(0, "patient_id", update.column("patient_id").cast(kept.column("patient_id").type))
+    patched = kept.join(update, "patient_id", join_type="left outer")
+    return patched.select(["patient_id"] + [name for name in order if name in patched.column_names]).sort_by("patient_id")
+
+
+# Extract ----------------------------------------------------------------------
+
+subset_definition = """\
+import sys
+sys.path.insert(0, {analysis_dir!r})
+from utility import load_dataset, subset_dataset
+dataset = subset_dataset(load_dataset({definition!r}, {user_args!r}), {names!r})
+"""
+
+def generate(definition, output, dummy_tables, user_args):
+    command = [sys.executable, "-m", "ehrql", "generate-dataset", definition, "--output", output]
+    if dummy_tables is not None:
+        command += ["--dummy-tables", dummy_tables]
+    if user_args:
+        command += ["--", *user_args]
+    subprocess.run(command, check=True)
+
+def generate_subset(definition, names, output, dummy_tables, user_args, workdir):
+    subset_file = os.path.join(workdir, "subset_definition.py")
+    with open(subset_file, "w") as f:
+        f.write(subset_definition.format(
+            analysis_dir=os.path.abspath(analysis_dir),
+            definition=os.path.abspath(definition),
+            user_args=list(user_args),
+            names=list(names),
+        ))
+    generate(subset_file, output, dummy_tables, ())
+
+
+def run(definition, output, dummy_tables=None, user_args=(), full=False):
+    start = time.perf_counter()
+    dataset = load_dataset(definition, user_args)
+    current = dict(
+        fingerprints=variable_fingerprints(dataset),
+        dummy_tables=tree_digest(dummy_tables) if dummy_tables else None,
+        user_args=list(user_args),
+    )
+    order = [name for name in current["fingerprints"] if name != "population"]
+    previous = None if full or dummy_tables is None else load_state(output)
+    changed = changed_variables(previous, current)
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    if changed is None:
+        generate(definition, output, dummy_tables, user_args)
+        summary = f"full extraction of {len(order)} variables"
+    elif changed or set(previous["fingerprints"]) - set(current["fingerprints"]):
+        workdir = tempfile.mkdtemp(prefix="incremental_extract_", dir=os.path.dirname(output) or ".")
+        try:
+            previous_output = read_output(output)
+            if changed:
+                # in the same format as the output, so patched columns are read as the same strings
+                subset_output = os.path.join(workdir, "subset" + output_suffix(output))
+                generate_subset(definition, changed, subset_output, dummy_tables, user_args, workdir)
+                update = read_output(subset_output)
+            else:
+                update = previous_output.select(["patient_id"])
+            write_output(patch(previous_output, update, changed, order), output)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        summary = f"re-extracted {len(changed)} of {len(order)} variables: {', '.join(changed) or 'none'}"
+    else:
+        summary = f"all {len(order)} variables unchanged"
+
+    save_state(output, current)
+    print(f"incremental extract: {summary} ({time.perf_counter() - start:.1f}s)", file=sys.stderr)
+    return changed
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    user_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, user_args = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description="Re-extract only the dataset variables whose definition changed")
+    parser.add_argument("definition")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--dummy-tables", default=None)
+    parser.add_argument("--full", action="store_true")
+    args = parser.parse_args(argv)
+
+    run(args.definition, args.output, args.dummy_tables, user_args, args.full)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# ------------------------------------------------------------------------------
+#
+# output_schema.py
+#
+# This file writes the schema sidecar of a typed (.arrow) dataset output: the
+# type of each column as ehrQL derived it from the dataset definition, the
+# R class it is read as, and the categories of categorical columns. It
+# describes the columns only, not their values
+#
+# Usage (from the repository root; needs pyarrow):
+#   python analysis/output_schema/output_schema.py \
+#     output/dataset_definition/input_prevax.arrow \
+#     output/dataset_definition/input_prevax.schema.json
+#
+# Arguments:
+#  - input - dataset output from ehrql generate-dataset (.arrow)
+#  - output - schema sidecar (.json)
+#
+# Returns:
+#  - One entry per column: name, arrow type, R class and (for dictionary
+#    encoded columns) categories
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+
+import pyarrow as pa
+
+
+# Column types -----------------------------------------------------------------
+# Classes as arrow::read_feather returns them
+
+def r_class(arrow_type):
+    if pa.types.is_dictionary(arrow_type):
+        return "factor"
+    if pa.types.is_boolean(arrow_type):
+        return "logical"
+    if pa.types.is_date(arrow_type):
+        return "Date"
+    if pa.types.is_integer(arrow_type):
+        return "integer"
+    if pa.types.is_floating(arrow_type):
+        return "numeric"
+    return "character"
+
+def column_categories(reader, index):
+    # the categories are declared in the definition, so each batch carries the
+    # same dictionary; read them all in case a writer chose otherwise
+    categories = []
+    for batch in range(reader.num_record_batches):
+        for value in reader.get_batch(batch).column(index).dictionary.to_pylist():
+            if value not in categories:
+                categories.append(value)
+    return categories
+
+def output_schema(path):
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    columns = []
+    for index, field in enumerate(reader.schema):
+        column = dict(name=field.name, type=str(field.type), r_class=r_class(field.type))
+        if pa.types.is_dictionary(field.type):
+            column["categories"] = column_categories(reader, index)
+        columns.append(column)
+    return dict(columns=columns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the schema sidecar of a typed dataset output")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    args = parser.parse_args(argv)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(output_schema(args.input), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# ------------------------------------------------------------------------------
+#
+# partitioned_extract.py
+#
+# This file extracts a dataset definition in K patient shards and merges them
+# back in patient_id order, so that generate_dates and generate_input_prevax
+# can run as K concurrent processes (or as K actions on separate machines)
+# with output identical to the unpartitioned run
+#
+# Usage (from the repository root, in an environment with ehrql installed):
+#   python analysis/partitioned_extract/partitioned_extract.py assign \
+#     output/dataset_definition/patients.arrow \
+#     --shards 8 --output output/dataset_definition/patient_shards.arrow
+#   python analysis/partitioned_extract/partitioned_extract.py merge \
+#     output/dataset_definition/input_prevax.arrow \
+#     output/dataset_definition/input_prevax_shard_*.arrow
+#   python analysis/partitioned_extract/partitioned_extract.py run \
+#     analysis/dataset_definition/dataset_definition_dates.py \
+#     --output output/dataset_definition/index_dates.arrow \
+#     --shards 8 [--jobs N] [--dummy-tables DIR] [-- USER_ARGS]
+#
+# Arguments:
+#  - assign - reads the patient list from dataset_definition_patients.py and
+#             writes each patient's shard: a stable hash of patient_id modulo
+#             --shards, the same on every run and machine
+#  - merge - merges shard outputs (.arrow, .csv or .csv.gz) into one output
+#            ordered by patient_id; CSV rows are copied as extracted
+#  - run - does all three locally: extracts the patient list, assigns
+#          shards, runs one generate-dataset per shard (with `--shard k`
+#          appended to USER_ARGS; see dataset_definition/patient_shards.py)
+#          in at most --jobs processes and merges them into --output
+#  - --dummy-tables - directory of tables to extract from; every shard must
+#                     read the same tables for the merge to equal the
+#                     unpartitioned output, so locally this should be given
+#
+# Returns:
+#  - assign: patient_id and shard (.arrow), read by patient_shards.py
+#  - merge and run: the dataset at --output
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import gzip
+import heapq
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+analysis_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, analysis_dir)
+
+from utility import csv_chunk_rows, output_suffix, write_gzip_chunks, write_output
+
+dataset_definition_dir = os.path.join(analysis_dir, "dataset_definition")
+patients_definition = os.path.join(dataset_definition_dir, "dataset_definition_patients.py")
+
+
+# Assign shards ----------------------------------------------------------------
+# splitmix64 finaliser: consecutive patient_ids spread evenly over the shards,
+# and the assignment does not depend on the Python hash seed or the machine
+
+def stable_hash(patient_ids):
+    x = np.asarray(patient_ids, dtype=np.int64).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def assign_shards(patient_ids, shards):
+    return (stable_hash(patient_ids) % np.uint64(shards)).astype(np.int64)
+
+def read_patient_ids(path):
+    if path.endswith(".arrow"):
+        table = pa.ipc.open_file(path).read_all()
+    else:
+        table = pa_csv.read_csv(path, convert_options=pa_csv.ConvertOptions(include_columns=["patient_id"]))
+    return table.column("patient_id").to_numpy()
+
+def assign(patients, shards, output):
+    patient_ids = read_patient_ids(patients)
+    table = pa.table(dict(
+        patient_id=pa.array(patient_ids, type=pa.int64()),
+        shard=pa.array(assign_shards(patient_ids, shards), type=pa.int64()),
+    ))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    write_output(table, output)
+    return table
+
+
+# Merge shards -----------------------------------------------------------------
+# ehrQL writes each shard ordered by patient_id and the shards are disjoint, so
+# a k-way merge on patient_id restores the unpartitioned order
+
+def open_text(path, mode="rt"):
+    return gzip.open(path, mode, newline="") if path.endswith(".gz") else open(path, mode, newline="")
+
+def csv_rows(f):
+    # one CSV row per item; a quoted value can span lines, and a row ends on a
+    # line with an even number of quotes in total
+    for line in f:
+        while line.count('"') % 2:
+            line += next(f)
+        yield line
+
+def row_patient_id(line):
+    return int(line.split(",", 1)[0])
+
+def merge_csv(output, shard_outputs):
+    files = [open_text(path) for path in shard_outputs]
+    try:
+        headers = {f.readline() for f in files}
+        if len(headers) != 1:
+            raise ValueError("shard outputs do not have the same columns")
+        lines = itertools.chain(headers, heapq.merge(*map(csv_rows, files), key=row_patient_id))
+        if output.endswith(".gz"):
+            # compressed on every core, a block of rows at a time (see utility.py)
+            chunks = iter(lambda: list(itertools.islice(lines, csv_chunk_rows)), [])
+            write_gzip_chunks(output, chunks, lambda chunk, first: "".join(chunk).encode())
+        else:
+            with open_text(output, "wt") as out:
+                out.writelines(lines)
+    finally:
+        for f in files:
+            f.close()
+
+def merge_arrow(output, shard_outputs):
+    tables = [pa.ipc.open_file(path).read_all() for path in shard_outputs]
+    if len({table.schema for table in tables}) != 1:
+        raise ValueError("shard outputs do not have the same columns")
+    write_output(pa.concat_tables(tables).sort_by("patient_id"), output)
+
+def merge(output, shard_outputs):
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    # written alongside the output, keeping its suffix (and so its format), then moved into place
+    tmp_output = os.path.join(os.path.dirname(output), f".{os.getpid()}.{os.path.basename(output)}")
+    (merge_arrow if output.endswith(".arrow") else merge_csv)(tmp_output, shard_outputs)
+    os.replace(tmp_output, output)
+
+
+# Run locally ------------------------------------------------------------------
+
+def generate(definition, output, dummy_tables, user_args, env=None):
+    command = [sys.executable, "-m", "ehrql", "generate-dataset", definition, "--output", output]
+    if dummy_tables is not None:
+        command += ["--dummy-tables", dummy_tables]
+    if user_args:
+        command += ["--", *user_args]
+    subprocess.run(command, check=True, env=env)
+
+def run(definition, output, shards, jobs=None, dummy_tables=None, user_args=()):
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="partitioned_extract_", dir=os.path.dirname(output) or ".")
+    try:
+        patients = os.path.join(workdir, "patients.arrow")
+        generate(patients_definition, patients, dummy_tables, ())
+        shards_file = os.path.abspath(os.path.join(workdir, "patient_shards.arrow"))
+        assign(patients, shards, shards_file)
+
+        env = dict(os.environ, PATIENT_SHARDS_PATH=shards_file)
+        shard_outputs = [os.path.join(workdir, f"shard_{k}" + output_suffix(output)) for k in range(shards)]
+        with ThreadPoolExecutor(max_workers=jobs or shards) as pool:
+            futures = [
+                pool.submit(generate, definition, shard_output, dummy_tables, [*user_args, "--shard", str(k)], env)
+                for k, shard_output in enumerate(shard_outputs)
+            ]
+            for future in futures:
+                future.result()
+        merge(output, shard_outputs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"partitioned extract: {output} from {shards} shards in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    user_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, user_args = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description="Extract a dataset definition in patient shards and merge them")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    assign_parser = commands.add_parser("assign", help="assign each patient to a shard")
+    assign_parser.add_argument("patients")
+    assign_parser.add_argument("--shards", type=int, required=True)
+    assign_parser.add_argument("--output", required=True)
+
+    merge_parser = commands.add_parser("merge", help="merge shard outputs in patient_id order")
+    merge_parser.add_argument("output")
+    merge_parser.add_argument("shard_outputs", nargs="+")
+
+    run_parser = commands.add_parser("run", help="extract all shards locally and merge them")
+    run_parser.add_argument("definition")
+    run_parser.add_argument("--output", required=True)
+    run_parser.add_argument("--shards", type=int, required=True)
+    run_parser.add_argument("--jobs", type=int, default=None)
+    run_parser.add_argument("--dummy-tables", default=None)
+
+    args = parser.parse_args(argv)
+    if args.command == "assign":
+        assign(args.patients, args.shards, args.output)
+    elif args.command == "merge":
+        merge(args.output, args.shard_outputs)
+    else:
+        run(args.definition, args.output, args.shards, args.jobs, args.dummy_tables, user_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# ------------------------------------------------------------------------------
+#
+# profile_dataset_definition.py
+#
+# This file profiles the query graph of an ehrQL dataset definition before it
+# is submitted, to show which variables dominate extraction cost
+#
+# Usage (from the repository root, in an environment with ehrQL v1 installed;
+# see require_ehrql in utility.py):
+#   python analysis/profile_dataset_definition/profile_dataset_definition.py \
+#     analysis/dataset_definition/dataset_definition_prevax.py \
+#     [--dummy-tables DIR] [--output FILE] [-- USER_ARGS]
+#
+# Arguments:
+#  - definition - path to the dataset definition (e.g. dataset_definition_dates.py)
+#  - --dummy-tables - optional directory of dummy tables; when given, each
+#                     variable is also evaluated with ehrQL's local file engine
+#                     and timed
+#  - --output - optional CSV path for the per-variable results
+#  - USER_ARGS - arguments passed through to the dataset definition
+#
+# Returns:
+#  - Per variable: variable group, tables scanned, number of codelist codes,
+#    whether a per-patient sort is required, number of scans (distinct event
+#    frames reduced to one row per patient) and, optionally, evaluation time
+#  - Dataset totals: distinct scans and tables across all variables, shared
+#    scans being counted once
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import csv
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utility import (
+    load_dataset,
+    dataset_variables,
+    dataset_population,
+    query_nodes,
+    variable_group,
+)
+
+
+# Query graph cost -------------------------------------------------------------
+
+def node_kind(node):
+    return type(node).__qualname__
+
+def is_table(node):
+    return node_kind(node) in ("SelectTable", "SelectPatientTable")
+
+def is_scan(node):
+    # an event frame reduced to one row (or value) per patient
+    kind = node_kind(node)
+    return kind == "PickOneRowPerPatient" or kind.startswith("AggregateByPatient.")
+
+def value_code_count(node):
+    # number of codes in a codelist literal (0 for any other node)
+    value = getattr(node, "value", None)
+    if node_kind(node) == "Value" and isinstance(value, (frozenset, tuple)):
+        return len(value)
+    return 0
+
+def profile_node(root):
+    nodes = query_nodes(root)
+    return dict(
+        tables=sorted({node.name for node in nodes if is_table(node)}),
+        codes=sum(value_code_count(node) for node in nodes),
+        sort=any(node_kind(node) == "Sort" for node in nodes),
+        scans={node.source for node in nodes if is_scan(node)},
+    )
+
+
+# Local evaluation -------------------------------------------------------------
+
+def time_variable(engine, population, name, series):
+    from ehrql import create_dataset
+
+    single = create_dataset()
+    single.define_population(population)
+    setattr(single, name, series)
+    start = time.perf_counter()
+    for table in engine.get_results_tables(single._compile()):
+        for _ in table:
+            pass
+    return time.perf_counter() - start
+
+
+# Profile ----------------------------------------------------------------------
+
+def profile(definition, dummy_tables=None, user_args=()):
+    dataset = load_dataset(definition, user_args)
+    variables = dataset_variables(dataset)
+    population = dataset_population(dataset)
+
+    engine = None
+    if dummy_tables is not None:
+        from ehrql.query_engines.local_file import LocalFileQueryEngine
+        engine = LocalFileQueryEngine(dummy_tables)
+
+    rows = []
+    all_scans, all_tables = set(), set()
+    for name, series in variables.items():
+        cost = profile_node(series._qm_node)
+        all_scans |= cost["scans"]
+        all_tables |= set(cost["tables"])
+        rows.append(dict(
+            variable=name,
+            group=variable_group(name),
+            tables=";".join(cost["tables"]),
+            codes=cost["codes"],
+            sort=cost["sort"],
+            scans=len(cost["scans"]),
+            seconds=(
+                round(time_variable(engine, population, name, series), 4)
+                if engine is not None else ""
+            ),
+        ))
+
+    totals = dict(
+        variables=len(rows),
+        distinct_scans=len(all_scans),
+        scans_if_unshared=sum(row["scans"] for row in rows),
+        tables=sorted(all_tables),
+    )
+    return rows, totals
+
+profile_columns = ["variable", "group", "tables", "codes", "sort", "scans", "seconds"]
+
+def print_profile(rows, totals, out=sys.stdout):
+    columns = profile_columns
+    widths = {
+        column: max([len(column)] + [len(str(row[column])) for row in rows]) for column in columns
+    }
+    print("  ".join(column.ljust(widths[column]) for column in columns), file=out)
+    for row in sorted(rows, key=lambda row: (-row["scans"], -row["codes"], row["variable"])):
+        print("  ".join(str(row[column]).ljust(widths[column]) for column in columns), file=out)
+    print(
+        f"\n{totals['variables']} variables, {totals['distinct_scans']} distinct scans "
+        f"({totals['scans_if_unshared']} if nothing were shared) over tables: "
+        f"{', '.join(totals['tables'])}",
+        file=out
+    )
+
+def write_profile(rows, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=profile_columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# Reports of the definition's own modules (printed at exit by ehrQL runs only
+# when DATASET_DEFINITION_REPORTS is set)
+
+def print_definition_reports():
+    codelists = sys.modules.get("codelists")
+    if codelists is not None:
+        codelists.report_loaded()
+    variable_helper_functions = sys.modules.get("variable_helper_functions")
+    if variable_helper_functions is not None:
+        variable_helper_functions.report_memo_stats()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    user_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, user_args = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description="Profile the query graph of an ehrQL dataset definition")
+    parser.add_argument("definition")
+    parser.add_argument("--dummy-tables", default=None)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    rows, totals = profile(args.definition, args.dummy_tables, user_args)
+    print_profile(rows, totals)
+    print_definition_reports()
+    if args.output:
+        write_profile(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# ------------------------------------------------------------------------------
+#
+# reshape_landmarks.py
+#
+# This file turns the wide landmark dataset (one row per patient, every
+# variable suffixed with its landmark, e.g. cov_bin_ami_landmark_20200101)
+# into a long table with one row per patient and landmark
+#
+# Usage (from the repository root; needs pyarrow):
+#   python analysis/reshape_landmarks/reshape_landmarks.py \
+#     output/dataset_definition/input_landmarks.arrow \
+#     output/reshape_landmarks/input_landmarks_long.arrow
+#
+# Arguments:
+#  - input - wide dataset from dataset_definition_landmarks.py (.arrow,
+#            .csv or .csv.gz)
+#  - output - long dataset (.arrow, .csv or .csv.gz)
+#
+# Returns:
+#  - One row per patient and landmark: patient_id, landmark (e.g.
+#    landmark_20200101), the landmark's variables without their suffix, and
+#    the variables shared by every landmark (e.g. vax_date_covid_1)
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import re
+import sys
+
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utility import read_output, write_output
+
+landmark_pattern = re.compile(r"^(?P<variable>.+)_(?P<landmark>landmark_\d{8})$")
+
+
+# Reshape ----------------------------------------------------------------------
+
+def reshape(wide):
+    landmark_columns = {}
+    shared = []
+    for name in wide.column_names:
+        match = landmark_pattern.match(name)
+        if match:
+            landmark_columns.setdefault(match["landmark"], {})[match["variable"]] = name
+        elif name != "patient_id":
+            shared.append(name)
+
+    variables = list(next(iter(landmark_columns.values()), {}))
+    for landmark, columns in landmark_columns.items():
+        if list(columns) != variables:
+            raise ValueError(f"{landmark} does not have the same variables as the other landmarks")
+
+    # one block of rows per landmark, with the landmark's columns renamed to the variable names
+    blocks = []
+    for landmark, columns in sorted(landmark_columns.items()):
+        block = {"patient_id": wide.column("patient_id")}
+        block["landmark"] = pa.array([landmark] * wide.num_rows, type=pa.string())
+        for variable, name in columns.items():
+            block[variable] = wide.column(name)
+        for name in shared:
+            block[name] = wide.column(name)
+        blocks.append(pa.table(block))
+    long = pa.concat_tables(blocks)
+    return long.sort_by([("patient_id", "ascending"), ("landmark", "ascending")])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reshape the wide landmark dataset to one row per patient and landmark")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    args = parser.parse_args(argv)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    write_output(reshape(read_output(args.input)), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# ------------------------------------------------------------------------------
+#
+# stream_output.py
+#
+# This file writes a dataset definition's output as .csv.gz batch by batch,
+# formatting and compressing the batches on every core (see "Streaming CSV
+# output" in utility.py), instead of through one single-threaded gzip stream
+# over the whole result
+#
+# Usage (from the repository root; generate needs ehrql installed):
+#   python analysis/stream_output/stream_output.py generate \
+#     analysis/dataset_definition/dataset_definition_prevax.py \
+#     --output output/dataset_definition/input_prevax.csv.gz \
+#     [--threads N] [--level L] [--dummy-tables DIR] [-- USER_ARGS]
+#   python analysis/stream_output/stream_output.py convert \
+#     output/dataset_definition/input_prevax.arrow \
+#     output/dataset_definition/input_prevax.csv.gz [--threads N] [--level L]
+#
+# Arguments:
+#  - generate - runs ehrql generate-dataset to an .arrow file alongside
+#               --output (ehrQL writes .arrow in row batches, without
+#               compressing) and converts it
+#  - convert - converts an .arrow output to .csv or .csv.gz, reading it one
+#              record batch at a time from a memory map
+#  - --threads - compression threads (default: all cores)
+#  - --level - gzip level (default 6)
+#
+# Returns:
+#  - The dataset at --output (or output), a single gzip member readable by
+#    any gzip reader, with values in ehrQL's CSV conventions (T/F booleans,
+#    floats with a decimal point, fields quoted only where needed)
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utility import write_csv_batches
+
+
+# Convert ----------------------------------------------------------------------
+
+def arrow_batches(path):
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    if reader.num_record_batches == 0:
+        yield pa.RecordBatch.from_pylist([], schema=reader.schema)
+    for index in range(reader.num_record_batches):
+        yield reader.get_batch(index)
+
+def convert(arrow_path, output, threads=None, level=6):
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    write_csv_batches(arrow_batches(arrow_path), output, threads, level)
+    print(f"stream output: {output} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+# Generate ---------------------------------------------------------------------
+
+def generate(definition, output, threads=None, level=6, dummy_tables=None, user_args=()):
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    arrow_path = os.path.join(os.path.dirname(output), f".{os.getpid()}.{os.path.basename(output)}.arrow")
+    command = [sys.executable, "-m", "ehrql", "generate-dataset", definition, "--output", arrow_path]
+    if dummy_tables is not None:
+        command += ["--dummy-tables", dummy_tables]
+    if user_args:
+        command += ["--", *user_args]
+    try:
+        subprocess.run(command, check=True)
+        convert(arrow_path, output, threads, level)
+    finally:
+        if os.path.exists(arrow_path):
+            os.remove(arrow_path)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    user_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, user_args = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(description="Write dataset outputs as .csv.gz with parallel compression")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="run a dataset definition and stream its output")
+    generate_parser.add_argument("definition")
+    generate_parser.add_argument("--output", required=True)
+    generate_parser.add_argument("--dummy-tables", default=None)
+
+    convert_parser = commands.add_parser("convert", help="convert an .arrow output")
+    convert_parser.add_argument("input")
+    convert_parser.add_argument("output")
+
+    for command_parser in (generate_parser, convert_parser):
+        command_parser.add_argument("--threads", type=int, default=None)
+        command_parser.add_argument("--level", type=int, default=6)
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        generate(args.definition, args.output, args.threads, args.level, args.dummy_tables, user_args)
+    else:
+        convert(args.input, args.output, args.threads, args.level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+# ------------------------------------------------------------------------------
+#
+# timeline_store.py
+#
+# This file builds and queries a per-codelist store of patient event dates, so
+# that "first/last matching event before/between dates" can be answered for
+# any index date (prevax, vax, unvax or a new landmark or sensitivity date)
+# with a binary search instead of re-filtering the event tables
+#
+# Usage (from the repository root; needs numpy and pyarrow):
+#   python analysis/timeline_store/timeline_store.py build TABLES_DIR STORE_DIR
+#   python analysis/timeline_store/timeline_store.py query STORE_DIR \
+#     --index-dates output/dataset_definition/index_dates.arrow \
+#     --start-column index_prevax [--end-column end_prevax_exposure] \
+#     [--last ami_snomed:gp] [--first ami_icd10:apc] [--exists copd_ctv3:gp] \
+#     --output FILE
+#
+# Arguments (build):
+#  - TABLES_DIR - directory of TPP tables in the formats read by ehrQL's local
+#                 file engine (e.g. dummy tables; clinical_events, medications,
+#                 apcs and ons_deaths are used)
+#  - STORE_DIR - directory to write the store into
+#
+# Arguments (query):
+#  - --index-dates - Arrow or CSV file with patient_id and date columns
+#  - --start-column, --end-column - index date columns to query against;
+#                                   --last and --exists look strictly before
+#                                   the start date, --first looks on or
+#                                   between the start and end dates
+#  - --last, --first, --exists - CODELIST:SOURCE to query (repeatable), where
+#                                SOURCE is gp, med, apc or death
+#  - --output - Arrow or CSV output path
+#
+# Returns:
+#  - build: one memory-mappable array per codelist and source
+#    (CODELIST.SOURCE.npy) and a manifest (manifest.json)
+#  - query: one row per patient with a {last,first,exists}_CODELIST_SOURCE
+#    column per query
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dataset_definition"))
+
+from utility import codelist_codes, read_output, write_output
+
+# Event dates are stored as one sorted int64 key per event:
+# patient_id << day_bits | days since epoch. A patient's events are then
+# contiguous and in date order, and any (patient, date) lookup is a single
+# np.searchsorted over the whole array
+epoch = np.datetime64("1900-01-01", "D")
+day_bits = 17  # 2^17 days from 1900 reaches beyond 2250
+
+# Sources searched for each coding system, matching variable_helper_functions.py
+sources = dict(
+    snomed=["gp"],
+    ctv3=["gp"],
+    dmd=["med"],
+    icd10=["apc", "death"],
+)
+
+ons_death_columns = ["underlying_cause_of_death"] + [f"cause_of_death_{i:02d}" for i in range(1, 16)]
+
+
+# Read tables ------------------------------------------------------------------
+# Tables are read a record batch at a time so memory use is bounded by the
+# matching events, not the size of the tables
+
+def table_path(tables_dir, table_name):
+    for suffix in (".arrow", ".csv.gz", ".csv"):
+        path = os.path.join(tables_dir, table_name + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+def read_batches(tables_dir, table_name, columns):
+    path = table_path(tables_dir, table_name)
+    if path is None:
+        return
+    if path.endswith(".arrow"):
+        reader = pa.ipc.open_file(path)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield batch.select([name for name in columns if name in batch.schema.names])
+    else:
+        reader = pa_csv.open_csv(
+            path,
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=columns,
+                include_missing_columns=True,
+                column_types={name: pa.string() for name in columns if name not in ("patient_id",)},
+            ),
+        )
+        for batch in reader:
+            yield batch
+
+def to_days(dates):
+    # dates as days since epoch (strings, as read from CSV, are parsed first)
+    if pa.types.is_string(dates.type):
+        dates = pc.cast(pc.strptime(dates, format="%Y-%m-%d", unit="s"), pa.date32())
+    days = np.asarray(pc.cast(dates, pa.date32()).to_numpy(zero_copy_only=False), dtype="datetime64[D]")
+    return (days - epoch).astype(np.int64)
+
+def event_keys(patient_id, days):
+    return (np.asarray(patient_id, dtype=np.int64) << day_bits) | days
+
+
+# Match codes ------------------------------------------------------------------
+
+def column_matches(column, codes):
+    return np.asarray(pc.fill_null(pc.is_in(column, value_set=codes), False), dtype=bool)
+
+def all_diagnoses_matches(all_diagnoses, codes):
+    # as apcs.all_diagnoses.contains_any_of: any code is a substring of the
+    # raw string, whatever its delimiters
+    pattern = "|".join(re.escape(code) for code in codes.to_pylist())
+    return np.asarray(pc.fill_null(pc.match_substring_regex(all_diagnoses, pattern), False), dtype=bool)
+
+
+# Build ------------------------------------------------------------------------
+
+def source_matches(source, batch, system, codes):
+    if source == "gp":
+        column = "ctv3_code" if system == "ctv3" else "snomedct_code"
+        return column_matches(batch.column(column), codes)
+    if source == "med":
+        return column_matches(batch.column("dmd_code"), codes)
+    if source == "apc":
+        return all_diagnoses_matches(batch.column("all_diagnoses"), codes)
+    matches = np.zeros(batch.num_rows, dtype=bool)
+    for column in ons_death_columns:
+        if column in batch.schema.names:
+            matches |= column_matches(batch.column(column), codes)
+    return matches
+
+source_tables = dict(
+    gp=("clinical_events", "date", ["patient_id", "date", "snomedct_code", "ctv3_code"]),
+    med=("medications", "date", ["patient_id", "date", "dmd_code"]),
+    apc=("apcs", "admission_date", ["patient_id", "admission_date", "all_diagnoses"]),
+    death=("ons_deaths", "date", ["patient_id", "date"] + ons_death_columns),
+)
+
+def build(tables_dir, store_dir):
+    start = time.perf_counter()
+    os.makedirs(store_dir, exist_ok=True)
+    # (codelist, source) -> [(system, codes)]
+    queries = {}
+    for name, systems in codelist_codes().items():
+        for system, codes in systems.items():
+            for source in sources[system]:
+                queries.setdefault((name, source), []).append((system, pa.array(sorted(codes))))
+
+    manifest = dict(epoch=str(epoch), day_bits=day_bits, tables_dir=tables_dir, timelines={})
+    for source, (table_name, date_column, columns) in source_tables.items():
+        source_queries = {key: value for key, value in queries.items() if key[1] == source}
+        keys = {key: [] for key in source_queries}
+        for batch in read_batches(tables_dir, table_name, columns):
+            patient_id = batch.column("patient_id").to_numpy(zero_copy_only=False)
+            days = to_days(batch.column(date_column))
+            dated = days >= 0
+            for key, codelists in source_queries.items():
+                matches = np.zeros(batch.num_rows, dtype=bool)
+                for system, codes in codelists:
+                    matches |= source_matches(source, batch, system, codes)
+                matches &= dated
+                keys[key].append(event_keys(patient_id[matches], days[matches]))
+        for (name, _), parts in keys.items():
+            # events on the same day are only stored once: only first, last and
+            # exists are answered
+            timeline = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+            np.save(os.path.join(store_dir, f"{name}.{source}.npy"), timeline)
+            manifest["timelines"][f"{name}.{source}"] = len(timeline)
+
+    with open(os.path.join(store_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(
+        f"timeline store: {len(manifest['timelines'])} timelines, "
+        f"{sum(manifest['timelines'].values())} events in {time.perf_counter() - start:.1f}s",
+        file=sys.stderr
+    )
+    return manifest
+
+
+# Query ------------------------------------------------------------------------
+# patient_id is an array of patient ids and dates are datetime64[D] values
+# (one per patient, or a single date for all). Results are datetime64[D]
+# arrays, NaT where a patient has no matching event
+
+class TimelineStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self._timelines = {}
+
+    def timeline(self, name, source):
+        key = f"{name}.{source}"
+        if key not in self.manifest["timelines"]:
+            raise KeyError(f"no timeline for codelist {name!r} and source {source!r}")
+        if key not in self._timelines:
+            self._timelines[key] = np.load(os.path.join(self.store_dir, f"{key}.npy"), mmap_mode="r")
+        return self._timelines[key]
+
+    def last_before(self, name, source, patient_id, date):
+        # last event strictly before date
+        timeline = self.timeline(name, source)
+        patient_id = np.asarray(patient_id, dtype=np.int64)
+        days = days_of(date)
+        position = np.searchsorted(timeline, event_keys(patient_id, np.maximum(days, 0))) - 1
+        found = (position >= 0) & ~np.isnat(np.asarray(date, dtype="datetime64[D]"))
+        key = np.where(found, timeline[np.maximum(position, 0)] if len(timeline) else 0, 0)
+        found &= (key >> day_bits) == patient_id
+        return dates_of(key, found)
+
+    def first_between(self, name, source, patient_id, start_date, end_date):
+        # first event on or between start_date and end_date
+        timeline = self.timeline(name, source)
+        patient_id = np.asarray(patient_id, dtype=np.int64)
+        days = days_of(start_date)
+        position = np.searchsorted(timeline, event_keys(patient_id, np.maximum(days, 0)))
+        found = (position < len(timeline)) & ~np.isnat(np.asarray(start_date, dtype="datetime64[D]"))
+        key = np.where(found, timeline[np.minimum(position, len(timeline) - 1)] if len(timeline) else 0, 0)
+        found &= (key >> day_bits) == patient_id
+        found &= (key & ((1 << day_bits) - 1)) <= days_of(end_date)
+        return dates_of(key, found)
+
+    def exists_before(self, name, source, patient_id, date):
+        return ~np.isnat(self.last_before(name, source, patient_id, date))
+
+def days_of(date):
+    return (np.asarray(date, dtype="datetime64[D]") - epoch).astype(np.int64)
+
+def dates_of(key, found):
+    dates = epoch + (key & ((1 << day_bits) - 1)).astype("timedelta64[D]")
+    return np.where(found, dates, np.datetime64("NaT"))
+
+
+# Query command ----------------------------------------------------------------
+
+def date_column(table, name):
+    column = table.column(name)
+    if pa.types.is_string(column.type):
+        column = pc.strptime(column, format="%Y-%m-%d", unit="s")
+    return pc.cast(column, pa.date32()).to_numpy(zero_copy_only=False).astype("datetime64[D]")
+
+def query(store_dir, index_dates, start_column, end_column, last, first, exists, output):
+    start = time.perf_counter()
+    store = TimelineStore(store_dir)
+    table = read_output(index_dates)
+    patient_id = table.column("patient_id").to_numpy(zero_copy_only=False)
+    start_date = date_column(table, start_column)
+    columns = dict(patient_id=pa.array(patient_id))
+    for spec in last:
+        name, source = spec.split(":")
+        columns[f"last_{name}_{source}"] = pa.array(store.last_before(name, source, patient_id, start_date))
+    if first:
+        if end_column is None:
+            raise ValueError("--first needs --end-column")
+        end_date = date_column(table, end_column)
+        for spec in first:
+            name, source = spec.split(":")
+            columns[f"first_{name}_{source}"] = pa.array(
+                store.first_between(name, source, patient_id, start_date, end_date)
+            )
+    for spec in exists:
+        name, source = spec.split(":")
+        columns[f"exists_{name}_{source}"] = pa.array(store.exists_before(name, source, patient_id, start_date))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    write_output(pa.table(columns), output)
+    print(f"timeline store: {len(patient_id)} patients in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and query per-codelist patient event timelines")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("tables_dir")
+    build_parser.add_argument("store_dir")
+
+    query_parser = subparsers.add_parser("query")
+    query_parser.add_argument("store_dir")
+    query_parser.add_argument("--index-dates", required=True)
+    query_parser.add_argument("--start-column", required=True)
+    query_parser.add_argument("--end-column", default=None)
+    query_parser.add_argument("--last", action="append", default=[], metavar="CODELIST:SOURCE")
+    query_parser.add_argument("--first", action="append", default=[], metavar="CODELIST:SOURCE")
+    query_parser.add_argument("--exists", action="append", default=[], metavar="CODELIST:SOURCE")
+    query_parser.add_argument("--output", required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        build(args.tables_dir, args.store_dir)
+    else:
+        query(
+            args.store_dir, args.index_dates, args.start_column, args.end_column,
+            args.last, args.first, args.exists, args.output,
+        )
+
+
+if __name__ == "__main__":
+    main()
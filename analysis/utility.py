@@ -0,0 +1,415 @@
+# ------------------------------------------------------------------------------
+#
+# utility.py
+#
+# Shared helpers for the Python tooling that inspects the ehrQL dataset
+# definitions locally (profiling, benchmarking, dummy data). The definitions
+# do not import it; importing this module needs only the standard library.
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import contextlib
+import csv
+import dataclasses
+import hashlib
+import os
+import re
+import runpy
+import sys
+
+
+# ehrQL internals --------------------------------------------------------------
+# The tools take datasets apart and evaluate them through ehrQL internals that
+# are not part of its public API (Dataset._variables, Dataset.population,
+# Dataset._compile and LocalFileQueryEngine.get_results_tables). They are
+# written against ehrQL v1, the release the project's ehrql:v1 actions run, and
+# require_ehrql fails with a clear error on any other version or API rather
+# than guessing
+
+supported_ehrql_major = 1
+
+def ehrql_version():
+    from importlib import metadata
+
+    for distribution in ("ehrql", "opensafely-ehrql"):
+        try:
+            return metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            pass
+    import ehrql
+
+    return getattr(ehrql, "__version__", "")
+
+def require_ehrql():
+    from ehrql import create_dataset
+    from ehrql.query_engines.local_file import LocalFileQueryEngine
+
+    version = ehrql_version()
+    supported = f"these tools support ehrQL v{supported_ehrql_major} (the ehrql:v{supported_ehrql_major} image)"
+    major = re.match(r"v?(\d+)\.", version)
+    if major and int(major.group(1)) != supported_ehrql_major:
+        raise RuntimeError(f"ehrQL {version} is installed, but {supported}")
+    dataset = create_dataset()
+    missing = [
+        name for name, present in (
+            ("Dataset._variables", "_variables" in vars(dataset)),
+            ("Dataset._compile", hasattr(dataset, "_compile")),
+            ("LocalFileQueryEngine.get_results_tables", hasattr(LocalFileQueryEngine, "get_results_tables")),
+        )
+        if not present
+    ]
+    if missing:
+        raise RuntimeError(f"ehrQL {version or '(unknown version)'} has no {', '.join(missing)}; {supported}")
+
+
+# Load a dataset definition ----------------------------------------------------
+# Runs the definition file as ehrQL would (from the repository root, with the
+# definition's directory on the import path and user arguments in sys.argv)
+# and returns its `dataset`, after checking the installed ehrQL (see above)
+
+def load_dataset(definition_file, user_args=()):
+    require_ehrql()
+    definition_dir = os.path.dirname(os.path.abspath(definition_file))
+    saved_path, saved_argv = list(sys.path), list(sys.argv)
+    sys.path.insert(0, definition_dir)
+    sys.argv = [definition_file, *user_args]
+    try:
+        namespace = runpy.run_path(definition_file, run_name="__main__")
+    finally:
+        sys.path[:] = saved_path
+        sys.argv = saved_argv
+    return namespace["dataset"]
+
+
+# Dataset variables and population ---------------------------------------------
+
+def dataset_variables(dataset):
+    return dict(dataset._variables)
+
+def dataset_population(dataset):
+    return dataset.population
+
+
+# Dataset with a subset of the variables (same population) --------------------
+
+def subset_dataset(dataset, names):
+    from ehrql import create_dataset
+
+    variables = dataset_variables(dataset)
+    subset = create_dataset()
+    subset.define_population(dataset_population(dataset))
+    # as the definitions configure it
+    subset.configure_dummy_data(population_size=int(os.environ.get("DUMMY_POPULATION_SIZE", 10000)))
+    for name in names:
+        setattr(subset, name, variables[name])
+    return subset
+
+
+# Read and write dataset outputs -----------------------------------------------
+# Outputs as written by ehrql generate-dataset (.arrow, .csv or .csv.gz). CSV
+# columns are read as strings so values are written back as they were
+# extracted (see "Streaming CSV output" below)
+
+def output_suffix(path):
+    name = os.path.basename(path)
+    return name[name.index("."):] if "." in name else ""
+
+def read_output(path):
+    import gzip
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    if path.endswith(".arrow"):
+        return pa.ipc.open_file(path).read_all()
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as f:
+        names = next(csv.reader(f))
+    return pa_csv.read_csv(
+        path,
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.int64() if name == "patient_id" else pa.string() for name in names},
+            strings_can_be_null=True,
+        ),
+    )
+
+def write_output(table, path, threads=None):
+    import pyarrow as pa
+
+    if path.endswith(".arrow"):
+        with replace_on_success(path) as tmp_path:
+            with pa.ipc.new_file(tmp_path, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        # an empty table has no batches, but its header is still written
+        batches = table.to_batches(max_chunksize=csv_chunk_rows) or [pa.RecordBatch.from_pylist([], schema=table.schema)]
+        write_csv_batches(batches, path, threads)
+
+@contextlib.contextmanager
+def replace_on_success(path):
+    # yields a temporary path that is moved to path if the block succeeds and
+    # removed if it fails, so a failed write leaves neither a partial output
+    # nor a temporary file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Streaming CSV output ---------------------------------------------------------
+# Row batches are formatted and gzip-compressed in a thread pool (pyarrow and
+# zlib release the GIL) and written in order as they complete, with at most
+# two chunks per thread in flight, so memory stays bounded and throughput
+# scales with cores. As in pigz, each chunk is a raw deflate stream ended with
+# a sync flush, so the chunks join into one ordinary gzip member that any
+# gzip reader (R's fread and read_csv included) accepts.
+#
+# Values follow ehrQL's CSV conventions: nothing is quoted unless it contains
+# a comma, quote or line break; booleans are T/F; floats always have a
+# decimal point (2.0, not 2); dates are ISO 8601; missing values are empty
+
+csv_chunk_rows = 64 * 1024
+
+def csv_field(name):
+    if any(character in name for character in ',"\r\n'):
+        return '"' + name.replace('"', '""') + '"'
+    return name
+
+def csv_column(column):
+    # the column's values as CSV fields (nulls stay null)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    if pa.types.is_boolean(column.type):
+        return pc.if_else(column, "T", "F")
+    if pa.types.is_floating(column.type):
+        text = column.cast(pa.string())
+        return pc.if_else(pc.match_substring_regex(text, r"^-?[0-9]+$"), pc.binary_join_element_wise(text, ".0", ""), text)
+    text = column.cast(pa.string())
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        quoted = pc.binary_join_element_wise('"', pc.replace_substring(text, '"', '""'), '"', "")
+        return pc.if_else(pc.match_substring_regex(text, '[,"\r\n]'), quoted, text)
+    return text
+
+def csv_bytes(batch, include_header):
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    header = (",".join(csv_field(name) for name in batch.schema.names) + "\n").encode() if include_header else b""
+    if batch.num_rows == 0:
+        return header
+    fields = [csv_column(column) for column in batch.columns]
+    lines = pc.binary_join_element_wise(*fields, ",", null_handling="replace", null_replacement="")
+    lines = pc.binary_join_element_wise(lines, "", "\n").cast(pa.string())
+    # the lines are contiguous in the array's data buffer
+    offsets = np.frombuffer(lines.buffers()[1], dtype=np.int32)[lines.offset:lines.offset + len(lines) + 1]
+    return header + memoryview(lines.buffers()[2])[offsets[0]:offsets[-1]].tobytes()
+
+def deflate_chunk(data, level):
+    import zlib
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return data, compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def write_gzip_chunks(path, chunks, encode, threads=None, level=6):
+    # chunks are encoded to bytes (encode(chunk, first)) and compressed by the
+    # pool; the file is written to a temporary path and moved into place
+    import collections
+    import struct
+    import zlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    threads = threads or os.cpu_count() or 1
+    crc, size = 0, 0
+    with replace_on_success(path) as tmp_path, open(tmp_path, "wb") as f, ThreadPoolExecutor(max_workers=threads) as pool:
+        f.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+        pending = collections.deque()
+
+        def write_next():
+            nonlocal crc, size
+            data, compressed = pending.popleft().result()
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            f.write(compressed)
+
+        for index, chunk in enumerate(chunks):
+            if len(pending) >= 2 * threads:
+                write_next()
+            pending.append(pool.submit(lambda chunk, first: deflate_chunk(encode(chunk, first), level), chunk, index == 0))
+        while pending:
+            write_next()
+        final = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        f.write(final.flush(zlib.Z_FINISH))
+        f.write(struct.pack("<II", crc & 0xFFFFFFFF, size & 0xFFFFFFFF))
+
+def write_csv_batches(batches, path, threads=None, level=6):
+    # batches of at most csv_chunk_rows rows, so large batches are split
+    # across the pool
+    def chunks():
+        for batch in batches:
+            for offset in range(0, max(batch.num_rows, 1), csv_chunk_rows):
+                yield batch.slice(offset, csv_chunk_rows)
+
+    if path.endswith(".gz"):
+        write_gzip_chunks(path, chunks(), csv_bytes, threads, level)
+    else:
+        with replace_on_success(path) as tmp_path, open(tmp_path, "wb") as f:
+            for index, chunk in enumerate(chunks()):
+                f.write(csv_bytes(chunk, index == 0))
+
+
+# Query model graph ------------------------------------------------------------
+# ehrQL query model nodes are frozen dataclasses; list every distinct node
+# reachable from `node` (each node once, children before parents)
+
+def query_nodes(node):
+    seen, ordered, stack = set(), [], [(node, False)]
+    while stack:
+        current, expanded = stack.pop()
+        if expanded:
+            ordered.append(current)
+        elif current not in seen:
+            seen.add(current)
+            stack.append((current, True))
+            stack.extend((child, False) for child in node_children(current))
+    return ordered
+
+def node_children(node):
+    for field in dataclasses.fields(node):
+        value = getattr(node, field.name)
+        if isinstance(value, dict):
+            candidates = value.values()
+        elif isinstance(value, (tuple, list, frozenset, set)):
+            candidates = value
+        else:
+            candidates = [value]
+        for child in candidates:
+            if dataclasses.is_dataclass(child) and not isinstance(child, type):
+                yield child
+
+
+# Query model fingerprint ------------------------------------------------------
+# A digest of the query graph that is stable across processes: sets are hashed
+# in sorted order, as their iteration order depends on PYTHONHASHSEED. Shared
+# subgraphs are only serialised once
+
+def query_fingerprint(node, memo=None):
+    memo = {} if memo is None else memo
+    return hashlib.sha256(canonical(node, memo).encode()).hexdigest()
+
+def canonical(value, memo):
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        key = id(value)
+        if key not in memo:
+            fields = ",".join(
+                f"{field.name}={canonical(getattr(value, field.name), memo)}"
+                for field in dataclasses.fields(value)
+            )
+            text = f"{type(value).__qualname__}({fields})"
+            memo[key] = (value, hashlib.sha256(text.encode()).hexdigest())
+        return memo[key][1]
+    if isinstance(value, (frozenset, set)):
+        return "{" + ",".join(sorted(canonical(item, memo) for item in value)) + "}"
+    if isinstance(value, (tuple, list)):
+        return "(" + ",".join(canonical(item, memo) for item in value) + ")"
+    if isinstance(value, dict):
+        return "{" + ",".join(
+            sorted(f"{canonical(k, memo)}:{canonical(v, memo)}" for k, v in value.items())
+        ) + "}"
+    if isinstance(value, type):
+        return value.__qualname__
+    return repr(value)
+
+
+# Variable fingerprints --------------------------------------------------------
+# One digest per dataset variable (and for the population) covering everything
+# its value depends on: the query graph, which holds codelist codes and study
+# dates as values, and the contents of any file read with @table_from_file
+# (e.g. index_dates), which the graph only refers to by path
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def tree_digest(directory, suffixes=None):
+    # digest of every file under directory (relative path and contents)
+    sha = hashlib.sha256()
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for name in sorted(names):
+            if name.startswith(".") or (suffixes and not name.endswith(suffixes)):
+                continue
+            path = os.path.join(root, name)
+            sha.update(os.path.relpath(path, directory).encode())
+            sha.update(file_digest(path).encode())
+    return sha.hexdigest()
+
+def table_files(root):
+    for node in query_nodes(root):
+        rows = getattr(node, "rows", None)
+        path = getattr(rows, "filename", None) or getattr(rows, "path", None)
+        if path is not None and os.path.isfile(path):
+            yield str(path)
+
+def variable_fingerprints(dataset):
+    roots = dict(population=dataset_population(dataset)._qm_node)
+    roots.update((name, series._qm_node) for name, series in dataset_variables(dataset).items())
+    memo, file_digests = {}, {}
+    fingerprints = {}
+    for name, root in roots.items():
+        sha = hashlib.sha256(query_fingerprint(root, memo).encode())
+        for path in sorted(set(table_files(root))):
+            if path not in file_digests:
+                file_digests[path] = file_digest(path)
+            sha.update(f"{path}={file_digests[path]}".encode())
+        fingerprints[name] = sha.hexdigest()
+    return fingerprints
+
+
+# Codelist codes ---------------------------------------------------------------
+# Codes of every codelist in codelists.py, read straight from the CSV sources
+# recorded on each LazyCodelist and grouped by the coding system declared
+# beside each codelist_from_csv. Codelists are never loaded, so ehrql is not
+# needed. Needs analysis/dataset_definition on the import path
+
+def read_codes(filename, column):
+    with open(filename, newline="") as f:
+        return [row[column] for row in csv.DictReader(f) if row.get(column)]
+
+def codelist_codes():
+    import codelists
+
+    codes = {}
+    for name, lazy_codelist in codelists.registry.items():
+        for filename, column, _, system in lazy_codelist.sources:
+            codes.setdefault(name, {}).setdefault(system, set()).update(read_codes(filename, column))
+    return codes
+
+
+# Variable groups --------------------------------------------------------------
+# Groups used when reporting per-variable results, matched on name prefix
+
+variable_groups = dict(
+    jcvi=("vax_jcvi_", "vax_cat_jcvi", "vax_date_eligible", "_group"),
+    vaccination=("vax_date_", "vax_num_"),
+    exposures=("exp_",),
+    outcomes=("out_", "tmp_out_"),
+    covariates=("cov_", "strat_", "sub_", "tmp_sub_"),
+    eligibility=("inex_", "qa_", "cens_", "index_", "end_"),
+)
+
+def variable_group(name):
+    for group, patterns in variable_groups.items():
+        if any(name.startswith(pattern) or name.endswith(pattern) for pattern in patterns):
+            return group
+    return "other"
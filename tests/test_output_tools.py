@@ -0,0 +1,148 @@
+# ------------------------------------------------------------------------------
+#
+# test_output_tools.py
+#
+# Tests for the Python output tools in analysis/ (incremental_extract,
+# partitioned_extract and the streaming CSV writer in utility.py), run on a
+# generated table shaped like an ehrQL output: sorted patient_ids, a column of
+# each type ehrQL writes, missing values and strings that need quoting. None
+# of them needs ehrql
+#
+# Usage (from the repository root; needs pyarrow, numpy and pytest):
+#   python -m pytest tests
+#
+# Authors: UoB ehrQL Team
+#
+# ------------------------------------------------------------------------------
+
+import gzip
+import importlib.util
+import os
+import sys
+import zlib
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+analysis_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis")
+sys.path.insert(0, analysis_dir)
+
+import utility
+
+
+def load_tool(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(analysis_dir, name, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+incremental_extract = load_tool("incremental_extract")
+partitioned_extract = load_tool("partitioned_extract")
+
+output_suffixes = [".arrow", ".csv", ".csv.gz"]
+
+
+# Generated outputs ------------------------------------------------------------
+
+def example_table(rows=5_000, seed=0, patient_ids=None):
+    rng = np.random.default_rng(seed)
+    if patient_ids is None:
+        patient_ids = np.sort(rng.choice(10 * rows, rows, replace=False)) + 1
+    rows = len(patient_ids)
+    missing = rng.random(rows) < 0.1
+    text = np.array(["none", "a,b", 'say "hi"', "two\nlines", ""], dtype=object)
+    return pa.table(dict(
+        patient_id=pa.array(patient_ids, type=pa.int64()),
+        flag=pa.array(rng.random(rows) < 0.5, mask=missing),
+        date=pa.array(rng.integers(-3650, 20000, rows), mask=missing).cast(pa.int32()).cast(pa.date32()),
+        value=pa.array(np.round(rng.normal(25, 10, rows) * 100) / 10 ** rng.integers(0, 3, rows), mask=missing),
+        count=pa.array(rng.integers(-5, 100, rows), mask=missing),
+        text=pa.array(text[rng.integers(0, len(text), rows)], type=pa.string(), mask=missing),
+        category=pa.array(rng.choice(["low", "mid", "high"], rows), mask=missing).dictionary_encode(),
+    ))
+
+def read_bytes(path):
+    return gzip.open(path).read() if path.endswith(".gz") else open(path, "rb").read()
+
+def assert_same_output(path, expected_path):
+    # .arrow outputs hold the same table; CSV outputs the same (uncompressed) bytes
+    if path.endswith(".arrow"):
+        assert utility.read_output(path).equals(utility.read_output(expected_path))
+    else:
+        assert read_bytes(path) == read_bytes(expected_path)
+
+
+# incremental_extract ----------------------------------------------------------
+# the previous output patched with re-extracted columns (in another row order),
+# with one variable removed from the definition, against the output the new
+# definition would give
+
+@pytest.mark.parametrize("suffix", output_suffixes)
+@pytest.mark.parametrize("changed", [["flag", "text"], []])
+def test_patch_matches_direct_output(tmp_path, suffix, changed):
+    previous = example_table(seed=0)
+    current = example_table(seed=1, patient_ids=previous.column("patient_id").to_numpy())
+    order = [name for name in previous.column_names if name not in ("patient_id", "count")]
+    expected = pa.table(dict(
+        patient_id=previous.column("patient_id"),
+        **{name: (current if name in changed else previous).column(name) for name in order},
+    ))
+    update = current.select(["patient_id", *changed]).take(np.random.default_rng(2).permutation(previous.num_rows))
+
+    paths = {name: str(tmp_path / (name + suffix)) for name in ("previous", "update", "patched", "expected")}
+    utility.write_output(previous, paths["previous"])
+    utility.write_output(update, paths["update"])
+    utility.write_output(expected, paths["expected"])
+    patched = incremental_extract.patch(
+        utility.read_output(paths["previous"]), utility.read_output(paths["update"]), changed, order
+    )
+    utility.write_output(patched, paths["patched"])
+    assert_same_output(paths["patched"], paths["expected"])
+
+
+# partitioned_extract ----------------------------------------------------------
+# each shard as ehrQL writes it (ordered by patient_id), merged, against the
+# unsharded output
+
+@pytest.mark.parametrize("suffix", output_suffixes)
+def test_merge_matches_unsharded_output(tmp_path, monkeypatch, suffix):
+    # several compressed blocks of rows
+    monkeypatch.setattr(partitioned_extract, "csv_chunk_rows", 1_000)
+    shards = 8
+    table = example_table()
+    shard = partitioned_extract.assign_shards(table.column("patient_id").to_numpy(), shards)
+
+    expected = str(tmp_path / ("expected" + suffix))
+    utility.write_output(table, expected)
+    shard_outputs = [str(tmp_path / (f"shard_{k}" + suffix)) for k in range(shards)]
+    for k, shard_output in enumerate(shard_outputs):
+        utility.write_output(table.filter(pa.array(shard == k)), shard_output)
+    merged = str(tmp_path / ("merged" + suffix))
+    partitioned_extract.merge(merged, shard_outputs)
+    assert_same_output(merged, expected)
+
+
+# Streaming CSV output ---------------------------------------------------------
+# Python's gzip module must read the parallel writer's output as the same bytes
+# as the whole table formatted at once, from a single gzip member
+
+@pytest.mark.parametrize("rows", [5_000, 0])
+@pytest.mark.parametrize("suffix", [".csv", ".csv.gz"])
+def test_csv_batches_match_whole_table(tmp_path, monkeypatch, rows, suffix):
+    # several batches, each split into several chunks
+    monkeypatch.setattr(utility, "csv_chunk_rows", 300)
+    table = example_table(rows=rows) if rows else example_table().slice(0, 0)
+    batches = table.to_batches(max_chunksize=1_000) or [pa.RecordBatch.from_pylist([], schema=table.schema)]
+    whole = table.combine_chunks().to_batches()[0] if rows else batches[0]
+
+    output = str(tmp_path / ("output" + suffix))
+    utility.write_csv_batches(batches, output, threads=4)
+    data = open(output, "rb").read()
+    if suffix == ".csv.gz":
+        member = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        member.decompress(data)
+        assert member.eof and not member.unused_data
+        data = gzip.decompress(data)
+    assert data == utility.csv_bytes(whole, True)
+    assert os.listdir(tmp_path) == [os.path.basename(output)]